@@ -0,0 +1,14 @@
+# benchmarks/__init__.py
+#
+# download() / process_data / upload_to_postgresql などの性能を計測するためのベンチマーク。
+# 使い方は benchmarks/run_benchmarks.py を参照。
+
+import os
+import sys
+
+# リポジトリ構成 (src/ と scripts/ が兄弟) のまま、コンテナ内と同じ import 文で読み込めるようにする
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SRC_DIR = os.path.join(ROOT_DIR, 'src')
+for _path in (SRC_DIR, ROOT_DIR):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
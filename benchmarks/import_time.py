@@ -0,0 +1,86 @@
+# benchmarks/import_time.py
+"""
+起動時間のベンチマーク。DB接続は不要。
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --repeats 20 --output benchmarks/results/import_time.json
+
+- app_import:   ワーカーが行う `import app` (preload_app 無効時はワーカーごと、有効時はマスターで1回)
+- loader_help:  `StockData_loader.py --help` (yfinance / pandas を読み込まずに終了するか)
+
+結果は run_benchmarks.py と同じ形式で保存するため、--compare でコミット間の比較ができる。
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+from benchmarks import ROOT_DIR, SRC_DIR
+
+TARGETS = {
+    "app_import": [sys.executable, "-c", "import app"],
+    "loader_help": [sys.executable, os.path.join(ROOT_DIR, "scripts", "StockData_loader.py"), "--help"],
+}
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([SRC_DIR, ROOT_DIR])
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    return env
+
+
+def time_command(command, repeats):
+    """コマンドを繰り返し実行し、各回の所要時間(秒)を返す"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT_DIR, env=_env(), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def slowest_imports(command, top):
+    """-X importtime の出力から、累積時間の大きいトップレベルモジュールを返す"""
+    result = subprocess.run([command[0], "-X", "importtime"] + command[1:], cwd=ROOT_DIR, env=_env(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    pattern = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+    modules = []
+    for line in result.stderr.splitlines():
+        match = pattern.match(line)
+        if match and len(match.group(3)) == 1: # インデント1 = 直接 import されたモジュール
+            modules.append((match.group(4), int(match.group(2)) / 1e6))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return [{"module": name, "cumulative_seconds": seconds} for name, seconds in modules[:top]]
+
+
+def main():
+    from benchmarks.run_benchmarks import summarize, git_revision, save_results
+
+    parser = argparse.ArgumentParser(description="Measure cold import / startup time of the app and loader.")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="表示する重いモジュールの数")
+    parser.add_argument("--output", help="結果JSONの保存先 (省略時は benchmarks/results/)")
+    args = parser.parse_args()
+
+    commit, dirty = git_revision()
+    results = {"git_commit": commit, "git_dirty": dirty, "params": vars(args).copy(), "benchmarks": {}}
+    for name, command in TARGETS.items():
+        print(f"--- {name} ---")
+        results["benchmarks"][name] = {
+            "latency": summarize(time_command(command, args.repeats)),
+            "slowest_imports": slowest_imports(command, args.top),
+        }
+        latency = results["benchmarks"][name]["latency"]
+        print(f"p50 {latency['p50'] * 1000:.0f} ms / max {latency['max'] * 1000:.0f} ms")
+        for item in results["benchmarks"][name]["slowest_imports"]:
+            print(f"  {item['module']:<30} {item['cumulative_seconds'] * 1000:8.1f} ms")
+    save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
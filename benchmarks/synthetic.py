@@ -0,0 +1,129 @@
+# benchmarks/synthetic.py
+
+import csv
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import ROOT_DIR
+
+# yfinance.download(group_by="ticker", auto_adjust=False, actions=True) と同じ列構成
+YF_FIELDS = ["Open", "High", "Low", "Close", "Adj Close", "Volume", "Dividends", "Stock Splits"]
+SPLIT_RATIOS = np.array([2.0, 3.0, 4.0, 5.0, 10.0])
+
+STOCKDATA_COLUMNS = [
+    "証券コード", "銘柄名", "日付", "始値", "高値", "安値", "終値",
+    "始値（調整後）", "高値（調整後）", "安値（調整後）", "終値（調整後）", "出来高"
+]
+
+
+def load_ticker_frame(n_tickers):
+    """data/tickers.csv の銘柄を使い、足りない分は架空の証券コードで補った (Ticker, CompanyName) を返す"""
+    df = pd.read_csv(os.path.join(ROOT_DIR, "data", "tickers.csv"), dtype=str)
+    df = df.rename(columns={"銘柄名": "CompanyName"}).dropna()
+    if len(df) >= n_tickers:
+        return df.head(n_tickers).reset_index(drop=True)
+
+    used = set(df["Ticker"])
+    extra = [f"{code:04d}" for code in range(1000, 10000) if f"{code:04d}" not in used]
+    extra = extra[:n_tickers - len(df)]
+    pad = pd.DataFrame({"Ticker": extra, "CompanyName": [f"合成銘柄{code}" for code in extra]})
+    return pd.concat([df, pad], ignore_index=True)
+
+
+def trading_days(start_date, end_date):
+    """平日を取引日とみなした日付インデックス (祝日は考慮しない)"""
+    return pd.bdate_range(start=start_date, end=end_date, name="Date")
+
+
+def generate_raw_chunk(tickers, start_date, end_date, seed=0, split_prob=0.0004, missing_prob=0.002, start_price=None):
+    """yfinance.download() と同じ形の MultiIndex (ticker, field) DataFrame を生成する。
+
+    価格は幾何ランダムウォークで、分割があった場合は yfinance と同様に
+    過去の価格を分割調整済みの値で返す。start_price (tickers と同じ順の未調整終値) を
+    指定すると、その価格から系列を続ける (既存データの続きを模す場合に使う)。
+    """
+    rng = np.random.default_rng(seed)
+    dates = trading_days(start_date, end_date)
+    n_days, n_tickers = len(dates), len(tickers)
+    if n_days == 0 or n_tickers == 0:
+        return pd.DataFrame()
+
+    # 1. 未調整の終値 (ランダムウォーク)
+    random_start = rng.uniform(100, 20000, size=n_tickers)
+    start_price = random_start if start_price is None else np.where(np.isnan(start_price), random_start, start_price)
+    returns = rng.normal(0.0002, 0.02, size=(n_days, n_tickers))
+    splits = np.where(rng.random((n_days, n_tickers)) < split_prob,
+                      rng.choice(SPLIT_RATIOS, size=(n_days, n_tickers)), 0.0)
+    split_step = np.where(splits > 0, splits, 1.0)
+    raw_close = start_price * np.exp(np.cumsum(returns, axis=0)) / np.cumprod(split_step, axis=0)
+
+    # 2. 分割調整 (以降の分割比率の累積で割る)
+    future_splits = np.cumprod(split_step[::-1], axis=0)[::-1] / split_step
+    close = raw_close / future_splits
+    open_ = close * (1 + rng.normal(0, 0.005, size=close.shape))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, size=close.shape)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, size=close.shape)))
+    volume = rng.lognormal(11, 1.5, size=close.shape).round() * future_splits
+    dividends = np.zeros_like(close)
+
+    fields = {
+        "Open": open_, "High": high, "Low": low, "Close": close, "Adj Close": close,
+        "Volume": volume, "Dividends": dividends, "Stock Splits": splits,
+    }
+
+    # 3. 上場前・データ欠損を模した NaN 行
+    missing = rng.random((n_days, n_tickers)) < missing_prob
+    frames = {}
+    for name, values in fields.items():
+        values = values.copy()
+        values[missing] = np.nan
+        frames[name] = pd.DataFrame(values, index=dates, columns=tickers)
+
+    df = pd.concat(frames, axis=1).swaplevel(0, 1, axis=1)
+    return df.reindex(columns=pd.MultiIndex.from_product([tickers, YF_FIELDS]))
+
+
+def iter_raw_chunks(yf_tickers, start_date, end_date, chunk_size=500, seed=0):
+    """ローダーと同じチャンク単位で (チャンク内ティッカー, 生データ) を順に返す"""
+    for i in range(0, len(yf_tickers), chunk_size):
+        chunk = yf_tickers[i:i + chunk_size]
+        yield chunk, generate_raw_chunk(chunk, start_date, end_date, seed=seed + i)
+
+
+def populate_stockdata(engine, ticker_df, start_date, end_date, table_name, chunk_size=500, seed=0):
+    """合成データを process_data と同じ変換で作成し、COPY で stockdata テーブルに投入する。
+
+    戻り値は投入した行数。
+    """
+    from scripts.StockData_loader import process_data
+
+    names = ticker_df.rename(columns={"Ticker": "証券コード", "CompanyName": "銘柄名"})
+    yf_tickers = [f"{ticker}.T" for ticker in ticker_df["Ticker"]]
+    total_rows = 0
+    for chunk, raw in iter_raw_chunks(yf_tickers, start_date, end_date, chunk_size, seed):
+        processed = process_data(raw, chunk)
+        del raw
+        if processed.empty:
+            continue
+        final_df = pd.merge(processed, names, on="証券コード", how="left").reindex(columns=STOCKDATA_COLUMNS)
+        copy_dataframe(engine, final_df, table_name)
+        total_rows += len(final_df)
+    return total_rows
+
+
+def copy_dataframe(engine, df, table_name):
+    """DataFrame を COPY FROM STDIN で高速に投入する"""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, quoting=csv.QUOTE_MINIMAL)
+    buffer.seek(0)
+    columns = ", ".join(f'"{col}"' for col in df.columns)
+    raw_connection = engine.raw_connection()
+    try:
+        with raw_connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY public."{table_name}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
@@ -3,15 +3,20 @@
 import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-import yfinance as yf
-import pandas as pd
+# yfinance / pandas は import に時間がかかるため、--help や「既に最新」で終了する実行では読み込まず、
+# 実際にデータを扱う関数の中で import する
 import os
 import time
 import traceback
 import sys
+import argparse
 from datetime import datetime, timedelta, date # ★変更点: dateを追加インポート
 from sqlalchemy import create_engine, text, inspect # ★変更点: inspectを追加インポート
 import config
+# ローダーは単発プロセスのため、gunicorn 用の multiprocess モードを使わずに記録する
+os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+import metrics
+from scripts import aggregates
 
 # ====================================================================
 # 1. GLOBAL SETTINGS
@@ -23,6 +28,7 @@ DATABASE_URL = (
     f"{config.DB_HOST}:{config.DB_PORT}/{config.DB_NAME}"
 )
 TABLE_NAME = "stockdata" # 保存先テーブル名を指定
+QUARANTINE_TABLE_NAME = config.TABLE_NAME_QUARANTINE # 検証で除外した行の保存先
 script_dir = os.path.dirname(os.path.abspath(__file__))
 TICKER_CSV_FILE = config.TICKER_CSV_FILE
 
@@ -30,6 +36,19 @@ TICKER_CSV_FILE = config.TICKER_CSV_FILE
 CHUNK_SIZE = 500
 DELAY_SECONDS = 30
 
+# --- 低メモリ (ストリーミング) モード用パラメータ ---
+STREAM_MEMORY_LIMIT_MB = int(os.getenv("LOADER_MEMORY_LIMIT_MB", "512"))
+STREAM_FLUSH_ROWS = 50000 # この行数たまるごとにステージングテーブルへ書き込む
+STREAM_MIN_CHUNK_SIZE = 10
+RAW_MEMORY_FACTOR = 4 # 生データに対する処理中のピークメモリの倍率 (生データ + 処理済みバッファ + to_sql の作業領域)
+FLOAT32_SAFE_MAX = 65536 # この値未満なら float32 でも小数第2位まで正確に復元できる
+
+DB_COLUMNS = [
+    "証券コード", "銘柄名", "日付", "始値", "高値", "安値", "終値",
+    "始値（調整後）", "高値（調整後）", "安値（調整後）", "終値（調整後）", "出来高"
+]
+PRICE_COLUMNS = ['始値', '高値', '安値', '終値', '始値（調整後）', '高値（調整後）', '安値（調整後）', '終値（調整後）']
+
 # ====================================================================
 # 2. 関数定義
 # ====================================================================
@@ -57,6 +76,7 @@ def get_latest_date_from_db(engine, table_name):
 
 def load_tickers_from_csv(file_path):
     """CSVからティッカーと会社名のDataFrameを読み込む。"""
+    import pandas as pd
     try:
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"ティッカーファイル '{file_path}' が見つかりません。")
@@ -90,6 +110,8 @@ def create_db_engine():
 
 def fetch_stock_data(tickers, start_date, end_date):
     """yfinanceからデータを1回で取得する。"""
+    import pandas as pd
+    import yfinance as yf
     if not tickers:
         return pd.DataFrame()
     print(f"\nFetching data for {len(tickers)} tickers from {start_date} to {end_date}...")
@@ -105,43 +127,51 @@ def fetch_stock_data(tickers, start_date, end_date):
         return pd.DataFrame()
 
 
+def process_ticker(df_raw, ticker):
+    """1銘柄分の未調整データと調整後データを作成する。データがない場合は None を返す。"""
+    import pandas as pd
+    if ticker not in df_raw.columns.get_level_values(0): return None
+    df_ticker = df_raw[ticker].copy().dropna(how="all").reset_index()
+    if df_ticker.empty or "Close" not in df_ticker.columns: return None
+
+    # 1. 分割係数を計算
+    if 'Stock Splits' in df_ticker.columns and (df_ticker['Stock Splits'] > 0).any():
+        df_ticker['split_factor'] = (df_ticker['Stock Splits'].replace(0, 1).iloc[::-1].cumprod().iloc[::-1])
+    else:
+        df_ticker['split_factor'] = 1
+
+    # 2. 未調整データ（復元）と調整後データ（yfinanceから）を生成
+    df_db = pd.DataFrame()
+    df_db['日付'] = pd.to_datetime(df_ticker['Date'])
+    df_db['始値'] = df_ticker['Open'] * df_ticker['split_factor']
+    df_db['高値'] = df_ticker['High'] * df_ticker['split_factor']
+    df_db['安値'] = df_ticker['Low'] * df_ticker['split_factor']
+    df_db['終値'] = df_ticker['Close'] * df_ticker['split_factor']
+    df_db['始値（調整後）'] = df_ticker['Open']
+    df_db['高値（調整後）'] = df_ticker['High']
+    df_db['安値（調整後）'] = df_ticker['Low']
+    df_db['終値（調整後）'] = df_ticker['Close']
+    df_db['出来高'] = df_ticker['Volume']
+    
+    # 3. データ型の整理と丸め処理
+    df_db[PRICE_COLUMNS] = df_db[PRICE_COLUMNS].round(2)
+    
+    df_db['証券コード'] = ticker.replace(".T", "")
+    df_db['日付'] = df_db['日付'].dt.date
+    df_db['出来高'] = df_db['出来高'].astype('int64')
+    
+    return df_db.dropna(subset=['始値', '高値', '安値', '終値'])
+
+
 def process_data(df_raw, tickers):
     """未調整データと調整後データをメモリ上でマージし、最終的なDataFrameを作成する。"""
+    import pandas as pd
     print("Processing raw data...")
     all_processed_data = []
     for ticker in tickers:
-        if ticker not in df_raw.columns.get_level_values(0): continue
-        df_ticker = df_raw[ticker].copy().dropna(how="all").reset_index()
-        if df_ticker.empty or "Close" not in df_ticker.columns: continue
-
-        # 1. 分割係数を計算
-        if 'Stock Splits' in df_ticker.columns and (df_ticker['Stock Splits'] > 0).any():
-            df_ticker['split_factor'] = (df_ticker['Stock Splits'].replace(0, 1).iloc[::-1].cumprod().iloc[::-1])
-        else:
-            df_ticker['split_factor'] = 1
-
-        # 2. 未調整データ（復元）と調整後データ（yfinanceから）を生成
-        df_db = pd.DataFrame()
-        df_db['日付'] = pd.to_datetime(df_ticker['Date'])
-        df_db['始値'] = df_ticker['Open'] * df_ticker['split_factor']
-        df_db['高値'] = df_ticker['High'] * df_ticker['split_factor']
-        df_db['安値'] = df_ticker['Low'] * df_ticker['split_factor']
-        df_db['終値'] = df_ticker['Close'] * df_ticker['split_factor']
-        df_db['始値（調整後）'] = df_ticker['Open']
-        df_db['高値（調整後）'] = df_ticker['High']
-        df_db['安値（調整後）'] = df_ticker['Low']
-        df_db['終値（調整後）'] = df_ticker['Close']
-        df_db['出来高'] = df_ticker['Volume']
-        
-        # 3. データ型の整理と丸め処理
-        price_cols = ['始値', '高値', '安値', '終値', '始値（調整後）', '高値（調整後）', '安値（調整後）', '終値（調整後）']
-        df_db[price_cols] = df_db[price_cols].round(2)
-        
-        df_db['証券コード'] = ticker.replace(".T", "")
-        df_db['日付'] = df_db['日付'].dt.date
-        df_db['出来高'] = df_db['出来高'].astype('int64')
-        
-        all_processed_data.append(df_db.dropna(subset=['始値', '高値', '安値', '終値']))
+        df_db = process_ticker(df_raw, ticker)
+        if df_db is not None:
+            all_processed_data.append(df_db)
 
     if not all_processed_data: return pd.DataFrame()
     final_df = pd.concat(all_processed_data, ignore_index=True)
@@ -149,56 +179,331 @@ def process_data(df_raw, tickers):
     return final_df
 
 
+def get_previous_closes(engine, df):
+    """チャンク内の各銘柄について、チャンク開始日より前の最新の未調整終値をDBから取得する。
+
+    隔離テーブルの行も候補に含める (同じ日付なら本テーブルを優先)。急変で隔離された
+    銘柄が、本テーブルに残る古い終値と比較され続けて毎回隔離されるのを防ぐ。
+    """
+    import pandas as pd
+    from scripts.data_validation import previous_closes
+    codes = [str(code) for code in df['証券コード'].unique()]
+    if not codes:
+        return pd.Series(dtype='float64')
+    # 銘柄ごとに各テーブルを (証券コード, 日付) の逆順に1行だけ読む
+    latest_rows = [
+        f"""
+        SELECT c.code AS "証券コード", s."日付", s."終値", {priority} AS priority
+        FROM unnest(CAST(:codes AS text[])) AS c(code)
+        CROSS JOIN LATERAL (
+            SELECT "日付", "終値" FROM public."{table_name}"
+            WHERE "証券コード" = c.code AND "日付" < :start_date
+            ORDER BY "日付" DESC
+            LIMIT 1
+        ) s
+        """
+        for priority, table_name in enumerate([QUARANTINE_TABLE_NAME, TABLE_NAME])
+    ]
+    query = text(" UNION ALL ".join(latest_rows) + " ORDER BY priority")
+    try:
+        with engine.connect() as connection:
+            rows = connection.execute(query, {"codes": codes, "start_date": df['日付'].min()}).fetchall()
+        history = pd.DataFrame(rows, columns=["証券コード", "日付", "終値", "priority"])
+        return previous_closes(history)
+    except Exception as e:
+        print(f"Could not fetch previous closes for validation: {e}", file=sys.stderr)
+        return pd.Series(dtype='float64')
+
+
+def validate_and_quarantine(engine, df):
+    """アップロード前にデータを検証し、疑わしい行を隔離テーブルへ移して残りの行を返す。"""
+    from scripts.data_validation import validate_rows, REASON_COLUMN
+    prev_close = get_previous_closes(engine, df)
+    with metrics.LOADER_STAGE_SECONDS.labels(stage="validate").time():
+        clean_df, quarantined_df, report = validate_rows(df, prev_close)
+
+    print(f"Validation: {report['rows']} rows checked, {report['quarantined']} quarantined {report['reasons']}, "
+          f"{report.get('missing_trading_days', 0)} missing trading days in {report.get('tickers_with_missing_days', 0)} tickers.")
+    for reason, count in report['reasons'].items():
+        metrics.LOADER_ROWS_QUARANTINED.labels(reason=reason).inc(count)
+    metrics.LOADER_MISSING_TRADING_DAYS.inc(report.get('missing_trading_days', 0))
+
+    if not quarantined_df.empty:
+        quarantined_df = quarantined_df.reindex(columns=DB_COLUMNS + [REASON_COLUMN])
+        quarantined_df['検出日時'] = datetime.now()
+        try:
+            quarantined_df.to_sql(QUARANTINE_TABLE_NAME, engine, index=False, if_exists='append', schema='public')
+        except Exception as e:
+            # 隔離できなかった行がどちらのテーブルにも残らないよう、チャンクごと失敗させる
+            print(f"Error writing quarantined rows to '{QUARANTINE_TABLE_NAME}': {e}", file=sys.stderr)
+            raise
+    return clean_df
+
+
+def merge_staging_table(engine, temp_table_name, table_name, columns):
+    """ステージングテーブルの内容を本テーブルにマージする (UPSERT処理)。"""
+    print(f"Merging data into main table: public.{table_name}...")
+    conflict_keys = '"証券コード", "日付"'
+    update_columns = [col for col in columns if col not in ['証券コード', '日付']]
+    update_set_string = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in update_columns])
+    insert_columns_string = ", ".join([f'"{col}"' for col in columns])
+
+    merge_sql = f"""
+    INSERT INTO public."{table_name}" ({insert_columns_string})
+    SELECT {insert_columns_string} FROM public."{temp_table_name}"
+    ON CONFLICT ({conflict_keys}) DO UPDATE SET
+        {update_set_string};
+    """
+
+    with engine.begin() as connection:
+        if table_name == TABLE_NAME:
+            # 集計テーブルはマージと同じトランザクションで、影響を受けたキーの分だけ更新する
+            aggregates.create_keys_table(connection)
+            merge_sql = aggregates.merge_returning_keys_sql(merge_sql)
+        with metrics.LOADER_STAGE_SECONDS.labels(stage="merge").time():
+            result = connection.execute(text(merge_sql))
+        if table_name == TABLE_NAME:
+            with metrics.LOADER_STAGE_SECONDS.labels(stage="aggregate").time():
+                aggregates.update_aggregates(connection)
+        print(f"Merge operation for '{table_name}' completed successfully.")
+    metrics.LOADER_ROWS_MERGED.labels(table=table_name).inc(max(result.rowcount, 0))
+
+
 def upload_to_postgresql(engine, df, table_name):
-    """DataFrameを指定されたテーブルにアップロードする (UPSERT処理)。"""
+    """DataFrameを指定されたテーブルにアップロードする (UPSERT処理)。成功したかどうかを返す。"""
     if df.empty:
         print(f"No data to upload for table '{table_name}'.")
-        return
+        return True
 
-    desired_order = [
-        "証券コード", "銘柄名", "日付", "始値", "高値", "安値", "終値", 
-        "始値（調整後）", "高値（調整後）", "安値（調整後）", "終値（調整後）", "出来高"
-    ]
-    df = df.reindex(columns=desired_order)
+    df = df.reindex(columns=DB_COLUMNS)
     
     temp_table_name = f"temp_{table_name}_{int(time.time())}"
     print(f"\nUploading {len(df)} rows to temporary table for '{table_name}': {temp_table_name}...")
 
     try:
-        df.to_sql(temp_table_name, engine, index=False, if_exists='replace', schema='public')
+        with metrics.LOADER_STAGE_SECONDS.labels(stage="upload").time():
+            df.to_sql(temp_table_name, engine, index=False, if_exists='replace', schema='public')
         print("Upload to temporary table successful.")
 
-        print(f"Merging data into main table: public.{table_name}...")
-        conflict_keys = '"証券コード", "日付"'
-        update_columns = [col for col in df.columns if col not in ['証券コード', '日付']]
-        update_set_string = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in update_columns])
-        insert_columns_string = ", ".join([f'"{col}"' for col in df.columns])
-
-        merge_sql = f"""
-        INSERT INTO public."{table_name}" ({insert_columns_string})
-        SELECT {insert_columns_string} FROM public."{temp_table_name}"
-        ON CONFLICT ({conflict_keys}) DO UPDATE SET
-            {update_set_string};
-        """
-        
-        with engine.begin() as connection:
-            connection.execute(text(merge_sql))
-            print(f"Merge operation for '{table_name}' completed successfully.")
+        merge_staging_table(engine, temp_table_name, table_name, df.columns)
+        return True
 
     except Exception as e:
         print(f"Error during data upload to PostgreSQL for '{table_name}': {e}", file=sys.stderr)
         traceback.print_exc()
+        return False
     finally:
         with engine.begin() as connection:
             connection.execute(text(f'DROP TABLE IF EXISTS public."{temp_table_name}"'))
             print(f"Temporary table {temp_table_name} deleted.")
 
 
+def run_chunked(db_engine, yf_tickers, ticker_df, start_date_str, end_date_str):
+    """CHUNK_SIZE 銘柄ずつまとめて取得・処理・アップロードする (通常モード)。失敗したチャンク数を返す。"""
+    import pandas as pd
+    ticker_chunks = [yf_tickers[i:i + CHUNK_SIZE] for i in range(0, len(yf_tickers), CHUNK_SIZE)]
+    failed_chunks = 0
+    
+    for i, ticker_chunk in enumerate(ticker_chunks):
+        print(f"\n--- Processing Chunk {i+1}/{len(ticker_chunks)} ({len(ticker_chunk)} tickers) ---")
+        with metrics.LOADER_STAGE_SECONDS.labels(stage="fetch").time():
+            raw_data = fetch_stock_data(ticker_chunk, start_date_str, end_date_str)
+        
+        if raw_data.empty:
+            print("No data fetched for this chunk. Skipping.")
+            metrics.LOADER_CHUNKS.labels(result="empty").inc()
+            continue
+
+        with metrics.LOADER_STAGE_SECONDS.labels(stage="process").time():
+            processed_df = process_data(raw_data, ticker_chunk)
+        
+        if processed_df.empty:
+            print("No data processed for this chunk. Skipping.")
+            metrics.LOADER_CHUNKS.labels(result="empty").inc()
+            continue
+            
+        print("Merging company names for the current chunk...")
+        # ★変更点: マージするカラム名を 'CompanyName' から '銘柄名' に合わせる
+        final_dataframe = pd.merge(processed_df, ticker_df, on="証券コード", how="left")
+        print("Merge complete.")
+
+        try:
+            final_dataframe = validate_and_quarantine(db_engine, final_dataframe)
+        except Exception as e:
+            print(f"Error during validation for chunk {i+1}. Skipping upload: {e}", file=sys.stderr)
+            traceback.print_exc()
+            metrics.LOADER_CHUNKS.labels(result="failed").inc()
+            failed_chunks += 1
+            continue
+
+        if final_dataframe.empty:
+            print("Final dataframe for this chunk is empty after merge. Skipping upload.")
+            continue
+
+        if upload_to_postgresql(db_engine, final_dataframe, TABLE_NAME):
+            metrics.LOADER_CHUNKS.labels(result="uploaded").inc()
+        else:
+            metrics.LOADER_CHUNKS.labels(result="failed").inc()
+            failed_chunks += 1
+
+        if i < len(ticker_chunks) - 1:
+            time.sleep(DELAY_SECONDS)
+            metrics.LOADER_RATE_LIMIT_WAIT_SECONDS.inc(DELAY_SECONDS)
+
+    return failed_chunks
+
+
 # ====================================================================
-# 3. メイン処理
+# 3. 低メモリ (ストリーミング) モード
 # ====================================================================
-def main():
+# 500銘柄 × 全期間の生データ・処理済みデータ・銘柄名マージ後のデータを同時に
+# 保持すると数GBになるため、メモリ上限から逆算したサブバッチ単位で取得し、
+# 銘柄ごとに処理してステージングテーブルへ逐次書き込む。
+
+def current_rss_mb():
+    """現在のプロセスのRSS (MB) を返す。取得できない環境では None を返す。"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def stream_chunk_size(memory_limit_mb, bytes_per_ticker):
+    """メモリ上限に収まる1回あたりの取得銘柄数を計算する。"""
+    baseline_mb = current_rss_mb() or 0
+    available_bytes = max(memory_limit_mb - baseline_mb, 0) * 1024 * 1024
+    size = int(available_bytes // max(bytes_per_ticker * RAW_MEMORY_FACTOR, 1))
+    return max(STREAM_MIN_CHUNK_SIZE, min(CHUNK_SIZE, size))
+
+
+def compact_dtypes(df_db, code_dtype, name_dtype, name_map):
+    """バッファに保持する間のメモリを減らすため、価格は float32 (安全な範囲のみ)、コード・銘柄名は category にする。"""
+    for col in PRICE_COLUMNS:
+        if df_db[col].abs().max() < FLOAT32_SAFE_MAX:
+            df_db[col] = df_db[col].astype('float32')
+    df_db['銘柄名'] = df_db['証券コード'].map(name_map).astype(name_dtype)
+    df_db['証券コード'] = df_db['証券コード'].astype(code_dtype)
+    return df_db
+
+
+def iter_processed_tickers(df_raw, tickers, code_dtype, name_dtype, name_map):
+    """銘柄ごとに処理済み (省メモリ型) の DataFrame を順に返す。"""
+    for ticker in tickers:
+        df_db = process_ticker(df_raw, ticker)
+        if df_db is None or df_db.empty:
+            continue
+        yield compact_dtypes(df_db, code_dtype, name_dtype, name_map)
+
+
+def append_to_staging(engine, buffered, temp_table_name):
+    """バッファの内容を通常の型に戻してステージングテーブルへ追記する。"""
+    import pandas as pd
+    df = pd.concat(buffered, ignore_index=True).reindex(columns=DB_COLUMNS)
+    # float32 のまま書き込むと 123.45 が 123.4499969... になるため、float64 に戻して丸め直す
+    df[PRICE_COLUMNS] = df[PRICE_COLUMNS].astype('float64').round(2)
+    df['証券コード'] = df['証券コード'].astype(str)
+    df['銘柄名'] = df['銘柄名'].astype(object)
+    df = validate_and_quarantine(engine, df)
+    if df.empty:
+        return 0
+    with metrics.LOADER_STAGE_SECONDS.labels(stage="upload").time():
+        df.to_sql(temp_table_name, engine, index=False, if_exists='append', schema='public')
+    return len(df)
+
+
+def run_streaming(db_engine, yf_tickers, ticker_df, start_date_str, end_date_str, memory_limit_mb):
+    """低メモリモードでデータを取得・処理・アップロードする。失敗したサブバッチ数を返す。"""
+    import pandas as pd
+    code_dtype = pd.CategoricalDtype(ticker_df["証券コード"].unique())
+    name_dtype = pd.CategoricalDtype(ticker_df["銘柄名"].dropna().unique())
+    name_map = dict(zip(ticker_df["証券コード"], ticker_df["銘柄名"]))
+
+    # 最初のサブバッチは、営業日数 × 8項目 × float64 で1銘柄あたりの生データ量を見積もる
+    n_days = max(len(pd.bdate_range(start_date_str, end_date_str)), 1)
+    chunk_size = stream_chunk_size(memory_limit_mb, n_days * 8 * 8)
+    print(f"Streaming mode: memory limit {memory_limit_mb} MB, initial chunk size {chunk_size} tickers.")
+
+    position = 0
+    batch_no = 0
+    failed_chunks = 0
+    while position < len(yf_tickers):
+        ticker_chunk = yf_tickers[position:position + chunk_size]
+        position += len(ticker_chunk)
+        batch_no += 1
+        print(f"\n--- Streaming batch {batch_no} ({len(ticker_chunk)} tickers, {position}/{len(yf_tickers)}) ---")
+
+        with metrics.LOADER_STAGE_SECONDS.labels(stage="fetch").time():
+            raw_data = fetch_stock_data(ticker_chunk, start_date_str, end_date_str)
+        if raw_data.empty:
+            print("No data fetched for this batch. Skipping.")
+            metrics.LOADER_CHUNKS.labels(result="empty").inc()
+        else:
+            # 実測した1銘柄あたりの生データ量で、次のサブバッチのサイズを調整する
+            bytes_per_ticker = raw_data.memory_usage(deep=True).sum() / len(ticker_chunk)
+            temp_table_name = f"temp_{TABLE_NAME}_{int(time.time())}_{batch_no}"
+            uploaded_rows = 0
+            try:
+                buffered, buffered_rows = [], 0
+                for df_db in iter_processed_tickers(raw_data, ticker_chunk, code_dtype, name_dtype, name_map):
+                    buffered.append(df_db)
+                    buffered_rows += len(df_db)
+                    if buffered_rows >= STREAM_FLUSH_ROWS:
+                        uploaded_rows += append_to_staging(db_engine, buffered, temp_table_name)
+                        buffered, buffered_rows = [], 0
+                # 生データはここで不要になるため、マージ前に解放する
+                del raw_data
+                if buffered:
+                    uploaded_rows += append_to_staging(db_engine, buffered, temp_table_name)
+                    buffered = []
+
+                if uploaded_rows:
+                    print(f"{uploaded_rows} rows written to {temp_table_name}.")
+                    merge_staging_table(db_engine, temp_table_name, TABLE_NAME, DB_COLUMNS)
+                    metrics.LOADER_CHUNKS.labels(result="uploaded").inc()
+                else:
+                    print("No data processed for this batch. Skipping.")
+                    metrics.LOADER_CHUNKS.labels(result="empty").inc()
+            except Exception as e:
+                print(f"Error during streaming upload for batch {batch_no}: {e}", file=sys.stderr)
+                traceback.print_exc()
+                metrics.LOADER_CHUNKS.labels(result="failed").inc()
+                failed_chunks += 1
+            finally:
+                with db_engine.begin() as connection:
+                    connection.execute(text(f'DROP TABLE IF EXISTS public."{temp_table_name}"'))
+
+            chunk_size = stream_chunk_size(memory_limit_mb, bytes_per_ticker)
+            rss_mb = current_rss_mb()
+            if rss_mb and rss_mb > memory_limit_mb:
+                chunk_size = max(STREAM_MIN_CHUNK_SIZE, chunk_size // 2)
+            print(f"RSS: {rss_mb or 0:.0f} MB. Next chunk size: {chunk_size} tickers.")
+
+        if position < len(yf_tickers):
+            # レート制限は取得銘柄数に比例するとみなし、待機時間もサブバッチの大きさに合わせる
+            delay = DELAY_SECONDS * len(ticker_chunk) / CHUNK_SIZE
+            time.sleep(delay)
+            metrics.LOADER_RATE_LIMIT_WAIT_SECONDS.inc(delay)
+
+    return failed_chunks
+
+
+# ====================================================================
+# 4. メイン処理
+# ====================================================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load Japanese stock prices from yfinance into PostgreSQL.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="低メモリモード: サブバッチ単位で取得し、銘柄ごとに処理・逐次アップロードする。")
+    parser.add_argument("--memory-limit-mb", type=int, default=STREAM_MEMORY_LIMIT_MB,
+                        help=f"低メモリモードのメモリ上限 (MB)。既定値: {STREAM_MEMORY_LIMIT_MB}")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """スクリプトのメイン実行関数。"""
+    args = parse_args(argv)
     start_time = time.time()
     print(f"--- Script started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
 
@@ -222,9 +527,13 @@ def main():
     # ★変更点: データベースが既に最新の場合、処理を終了する
     if datetime.strptime(start_date_str, "%Y-%m-%d").date() > today.date():
         print("Database is already up to date. No new data to fetch. Exiting.")
+        metrics.LOADER_LAST_SUCCESS_TIMESTAMP.set_to_current_time()
+        metrics.write_loader_textfile(config.LOADER_METRICS_TEXTFILE)
         return
 
     print(f"Target Period: {start_date_str} to {end_date_str}")
+    # 集計テーブルが未作成・未構築なら、既存の日足から構築しておく (取り込みがある実行でのみ行う)
+    aggregates.ensure_aggregates(db_engine)
     
     # ★変更点: DBエンジン作成処理は先頭に移動済み
     # db_engine = create_db_engine()
@@ -243,38 +552,21 @@ def main():
     # ★変更点: カラム名を 'CompanyName' から '銘柄名' に合わせる
     ticker_df = ticker_df.rename(columns={"Ticker": "証券コード", "CompanyName": "銘柄名"})
     
-    ticker_chunks = [yf_tickers[i:i + CHUNK_SIZE] for i in range(0, len(yf_tickers), CHUNK_SIZE)]
-    
-    for i, ticker_chunk in enumerate(ticker_chunks):
-        print(f"\n--- Processing Chunk {i+1}/{len(ticker_chunks)} ({len(ticker_chunk)} tickers) ---")
-        raw_data = fetch_stock_data(ticker_chunk, start_date_str, end_date_str)
-        
-        if raw_data.empty:
-            print("No data fetched for this chunk. Skipping.")
-            continue
-
-        processed_df = process_data(raw_data, ticker_chunk)
-        
-        if processed_df.empty:
-            print("No data processed for this chunk. Skipping.")
-            continue
-            
-        print("Merging company names for the current chunk...")
-        # ★変更点: マージするカラム名を 'CompanyName' から '銘柄名' に合わせる
-        final_dataframe = pd.merge(processed_df, ticker_df, on="証券コード", how="left")
-        print("Merge complete.")
-
-        if final_dataframe.empty:
-            print("Final dataframe for this chunk is empty after merge. Skipping upload.")
-            continue
-
-        upload_to_postgresql(db_engine, final_dataframe, TABLE_NAME)
-
-        if i < len(ticker_chunks) - 1:
-            time.sleep(DELAY_SECONDS)
+    if args.streaming:
+        failed_chunks = run_streaming(db_engine, yf_tickers, ticker_df, start_date_str, end_date_str, args.memory_limit_mb)
+    else:
+        failed_chunks = run_chunked(db_engine, yf_tickers, ticker_df, start_date_str, end_date_str)
 
     end_time = time.time()
     print(f"\n--- All chunks processed. Process finished in {end_time - start_time:.2f} seconds ---")
+    metrics.LOADER_LAST_RUN_SECONDS.set(end_time - start_time)
+    if failed_chunks:
+        # 最終成功時刻を更新しないことで、失敗したチャンクがあった実行をアラートで検知できるようにする
+        print(f"{failed_chunks} chunk(s) failed. Not recording this run as successful.", file=sys.stderr)
+        metrics.restore_last_success(config.LOADER_METRICS_TEXTFILE)
+    else:
+        metrics.LOADER_LAST_SUCCESS_TIMESTAMP.set_to_current_time()
+    metrics.write_loader_textfile(config.LOADER_METRICS_TEXTFILE)
 
 
 if __name__ == "__main__":
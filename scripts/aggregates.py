@@ -0,0 +1,184 @@
+# scripts/aggregates.py
+
+import os
+import sys
+import time
+import argparse
+from sqlalchemy import create_engine, text, inspect
+
+# このスクリプトの親ディレクトリ(/app)を検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+
+# マージで追加・更新された (証券コード, 日付) を保持する一時テーブル (トランザクション終了時に削除)
+KEYS_TABLE = "merged_keys"
+
+AGGREGATE_TABLES = [config.TABLE_NAME_LATEST, config.TABLE_NAME_WEEKLY, config.TABLE_NAME_MONTHLY, config.TABLE_NAME_COVERAGE]
+
+DAILY_COLUMNS = [
+    "証券コード", "銘柄名", "日付", "始値", "高値", "安値", "終値",
+    "始値（調整後）", "高値（調整後）", "安値（調整後）", "終値（調整後）", "出来高"
+]
+BAR_VALUE_COLUMNS = [
+    "銘柄名", "期間終了日", "始値", "高値", "安値", "終値",
+    "始値（調整後）", "高値（調整後）", "安値（調整後）", "終値（調整後）", "出来高", "日数"
+]
+BAR_TABLES = {config.TABLE_NAME_WEEKLY: "week", config.TABLE_NAME_MONTHLY: "month"}
+
+
+def _quote(columns, prefix=""):
+    return ", ".join(f'{prefix}"{col}"' for col in columns)
+
+
+def _update_set(columns):
+    return ", ".join(f'"{col}" = EXCLUDED."{col}"' for col in columns)
+
+
+def create_keys_table(connection):
+    """マージ結果のキーを受け取る一時テーブルを作成する (同じトランザクション内で使う)。"""
+    connection.execute(text(f'''
+        CREATE TEMP TABLE {KEYS_TABLE} ("証券コード" VARCHAR(10), "日付" DATE, inserted BOOLEAN)
+        ON COMMIT DROP
+    '''))
+
+
+def merge_returning_keys_sql(merge_sql):
+    """INSERT ... ON CONFLICT 文を、処理したキーを一時テーブルに記録する形に書き換える。
+
+    xmax = 0 の行は新規に挿入された行 (更新された行は xmax に更新トランザクションIDが入る)。
+    """
+    return f'''
+        WITH merged AS (
+            {merge_sql.rstrip().rstrip(";")}
+            RETURNING "証券コード", "日付", (xmax = 0) AS inserted
+        )
+        INSERT INTO {KEYS_TABLE} SELECT "証券コード", "日付", inserted FROM merged
+    '''
+
+
+def update_latest(connection):
+    """銘柄ごとの最新の日足を更新する。"""
+    update_columns = [col for col in DAILY_COLUMNS if col != "証券コード"]
+    connection.execute(text(f'''
+        INSERT INTO public."{config.TABLE_NAME_LATEST}" AS latest ({_quote(DAILY_COLUMNS)})
+        SELECT {_quote(DAILY_COLUMNS, "s.")}
+        FROM (SELECT "証券コード", MAX("日付") AS "日付" FROM {KEYS_TABLE} GROUP BY "証券コード") k
+        JOIN public."{config.TABLE_NAME}" s USING ("証券コード", "日付")
+        ON CONFLICT ("証券コード") DO UPDATE SET {_update_set(update_columns)}
+        WHERE EXCLUDED."日付" >= latest."日付"
+    '''))
+
+
+def update_bars(connection, table_name, unit):
+    """影響を受けた (証券コード, 期間) だけを日足から集計し直し、週足・月足を更新する。"""
+    connection.execute(text(f'''
+        WITH periods AS (
+            SELECT DISTINCT "証券コード", date_trunc('{unit}', "日付")::date AS period_start
+            FROM {KEYS_TABLE}
+        )
+        INSERT INTO public."{table_name}" ("証券コード", "期間開始日", {_quote(BAR_VALUE_COLUMNS)})
+        SELECT
+            p."証券コード",
+            p.period_start,
+            (array_agg(s."銘柄名" ORDER BY s."日付" DESC))[1],
+            MAX(s."日付"),
+            (array_agg(s."始値" ORDER BY s."日付"))[1],
+            MAX(s."高値"),
+            MIN(s."安値"),
+            (array_agg(s."終値" ORDER BY s."日付" DESC))[1],
+            (array_agg(s."始値（調整後）" ORDER BY s."日付"))[1],
+            MAX(s."高値（調整後）"),
+            MIN(s."安値（調整後）"),
+            (array_agg(s."終値（調整後）" ORDER BY s."日付" DESC))[1],
+            SUM(s."出来高"),
+            COUNT(*)
+        FROM periods p
+        JOIN public."{config.TABLE_NAME}" s
+            ON s."証券コード" = p."証券コード"
+            AND s."日付" >= p.period_start
+            AND s."日付" < p.period_start + interval '1 {unit}'
+        GROUP BY p."証券コード", p.period_start
+        ON CONFLICT ("証券コード", "期間開始日") DO UPDATE SET {_update_set(BAR_VALUE_COLUMNS)}
+    '''))
+
+
+def update_coverage(connection):
+    """銘柄ごとの収録期間と日数を、新規に挿入された行の分だけ加算して更新する。"""
+    connection.execute(text(f'''
+        INSERT INTO public."{config.TABLE_NAME_COVERAGE}" AS coverage ("証券コード", "開始日", "終了日", "日数")
+        SELECT "証券コード", MIN("日付"), MAX("日付"), COUNT(*) FILTER (WHERE inserted)
+        FROM {KEYS_TABLE}
+        GROUP BY "証券コード"
+        ON CONFLICT ("証券コード") DO UPDATE SET
+            "開始日" = LEAST(coverage."開始日", EXCLUDED."開始日"),
+            "終了日" = GREATEST(coverage."終了日", EXCLUDED."終了日"),
+            "日数" = coverage."日数" + EXCLUDED."日数"
+    '''))
+
+
+def update_aggregates(connection):
+    """一時テーブルのキーをもとに、全ての集計テーブルを更新する (マージと同じトランザクションで呼ぶ)。"""
+    update_latest(connection)
+    for table_name, unit in BAR_TABLES.items():
+        update_bars(connection, table_name, unit)
+    update_coverage(connection)
+
+
+def rebuild_aggregates(engine, codes=None):
+    """stockdata から集計テーブルを作り直す (初回構築・不整合の修復用)。
+
+    codes (証券コードのリスト) を指定した場合は、その銘柄の集計だけを作り直す。
+    """
+    print(f"Rebuilding aggregate tables from the daily data{f' ({len(codes)} tickers)' if codes else ''}...")
+    start_time = time.time()
+    with engine.begin() as connection:
+        if codes:
+            params = {"codes": list(codes)}
+            for table in AGGREGATE_TABLES:
+                connection.execute(text(f'DELETE FROM public."{table}" WHERE "証券コード" = ANY(:codes)'), params)
+            where = 'WHERE "証券コード" = ANY(:codes)'
+        else:
+            params = {}
+            table_list = ", ".join(f'public."{table}"' for table in AGGREGATE_TABLES)
+            connection.execute(text(f'TRUNCATE {table_list}'))
+            where = ''
+        create_keys_table(connection)
+        connection.execute(text(
+            f'INSERT INTO {KEYS_TABLE} SELECT "証券コード", "日付", true FROM public."{config.TABLE_NAME}" {where}'
+        ), params)
+        update_aggregates(connection)
+    print(f"Aggregate tables rebuilt in {time.time() - start_time:.2f} seconds.")
+
+
+def ensure_aggregates(engine):
+    """集計テーブルがなければ作成し、未構築 (日足はあるのに空) なら全体から構築する。"""
+    inspector = inspect(engine)
+    if not all(inspector.has_table(table) for table in AGGREGATE_TABLES):
+        from scripts.create_table import create_tables
+        create_tables(engine)
+    with engine.connect() as connection:
+        has_daily = connection.execute(text(f'SELECT EXISTS (SELECT 1 FROM public."{config.TABLE_NAME}")')).scalar()
+        has_coverage = connection.execute(text(f'SELECT EXISTS (SELECT 1 FROM public."{config.TABLE_NAME_COVERAGE}")')).scalar()
+    if has_daily and not has_coverage:
+        rebuild_aggregates(engine)
+
+
+def main():
+    """コマンドライン引数を解釈して、集計テーブルを作り直します。"""
+    parser = argparse.ArgumentParser(description="Maintain aggregate tables (latest bar, weekly/monthly bars, coverage).")
+    subparsers = parser.add_subparsers(dest="command", required=True, help="Available commands")
+    parser_rebuild = subparsers.add_parser("rebuild", help="Rebuild aggregate tables from stockdata.")
+    parser_rebuild.add_argument("--tickers", nargs="+", help="Rebuild only these ticker codes (default: all).")
+    args = parser.parse_args()
+
+    try:
+        engine = create_engine(config.DATABASE_URL)
+        if args.command == "rebuild":
+            from scripts.create_table import create_tables
+            create_tables(engine)
+            rebuild_aggregates(engine, args.tickers)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    main()
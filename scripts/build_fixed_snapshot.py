@@ -0,0 +1,160 @@
+# scripts/build_fixed_snapshot.py
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+# このスクリプトの親ディレクトリ(/app)を検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import config
+from scripts.create_table import create_tables, fixed_table_name
+
+# 切り替え時にロック待ちで読み取りクエリを長時間ブロックしないよう、短いタイムアウトで再試行する
+SWAP_LOCK_TIMEOUT = "5s"
+SWAP_RETRIES = 5
+SWAP_RETRY_DELAY_SECONDS = 10
+
+
+def build_snapshot_table(engine, build_table, start_date, end_date):
+    """stockdata から期間を切り出した新しいテーブルを作成し、作成後にインデックスを張る。"""
+    print(f"Creating {build_table} from public.\"{config.TABLE_NAME}\" ({start_date} to {end_date})...")
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS public."{build_table}"'))
+        # ダウンロード時の ORDER BY と同じ順序で格納し、読み出し時のランダムアクセスを減らす
+        connection.execute(text(f'''
+            CREATE TABLE public."{build_table}" AS
+            SELECT * FROM public."{config.TABLE_NAME}"
+            WHERE "日付" BETWEEN :start_date AND :end_date
+            ORDER BY "証券コード", "日付"
+        '''), {"start_date": start_date, "end_date": end_date})
+
+    # データ投入後にまとめて作成する方が、行ごとにインデックスを更新するより速い
+    print("Building indexes...")
+    with engine.begin() as connection:
+        connection.execute(text(
+            f'ALTER TABLE public."{build_table}" ADD CONSTRAINT "{build_table}_pkey" PRIMARY KEY ("証券コード", "日付")'
+        ))
+        connection.execute(text(f'CREATE INDEX "{build_table}_date_idx" ON public."{build_table}" ("日付")'))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f'ANALYZE public."{build_table}"'))
+
+    with engine.connect() as connection:
+        row_count, min_date, max_date = connection.execute(text(
+            f'SELECT COUNT(*), MIN("日付"), MAX("日付") FROM public."{build_table}"'
+        )).fetchone()
+    print(f"{row_count} rows copied ({min_date} to {max_date}).")
+    return row_count, min_date, max_date
+
+
+def swap_in(engine, build_table, target_table, version, row_count, min_date, max_date):
+    """作成したテーブルを1トランザクションで公開名にリネームし、登録情報を更新する。
+
+    旧テーブルのリネーム名を返す (旧テーブルがない場合は None)。
+    """
+    # 作業用テーブルの名前は stockdata_fixed で始めない (どの版のテーブル名とも重ならないようにする)
+    old_table = f"old_{int(time.time())}_{target_table}"
+    for attempt in range(1, SWAP_RETRIES + 1):
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+                exists = connection.execute(
+                    text("SELECT to_regclass(:name) IS NOT NULL"), {"name": f'public."{target_table}"'}
+                ).scalar()
+                if exists:
+                    connection.execute(text(f'ALTER TABLE public."{target_table}" RENAME TO "{old_table}"'))
+                    connection.execute(text(f'ALTER INDEX IF EXISTS public."{target_table}_pkey" RENAME TO "{old_table}_pkey"'))
+                    connection.execute(text(f'ALTER INDEX IF EXISTS public."{target_table}_date_idx" RENAME TO "{old_table}_date_idx"'))
+                connection.execute(text(f'ALTER TABLE public."{build_table}" RENAME TO "{target_table}"'))
+                connection.execute(text(f'ALTER INDEX public."{build_table}_pkey" RENAME TO "{target_table}_pkey"'))
+                connection.execute(text(f'ALTER INDEX public."{build_table}_date_idx" RENAME TO "{target_table}_date_idx"'))
+                connection.execute(text(f'''
+                    INSERT INTO public."{config.TABLE_NAME_SNAPSHOTS}" (table_name, version, min_date, max_date, row_count, created_at)
+                    VALUES (:table_name, :version, :min_date, :max_date, :row_count, now())
+                    ON CONFLICT (table_name) DO UPDATE SET
+                        version = EXCLUDED.version, min_date = EXCLUDED.min_date, max_date = EXCLUDED.max_date,
+                        row_count = EXCLUDED.row_count, created_at = EXCLUDED.created_at
+                '''), {"table_name": target_table, "version": version, "min_date": min_date,
+                       "max_date": max_date, "row_count": row_count})
+            print(f"Swapped {build_table} into public.\"{target_table}\".")
+            return old_table if exists else None
+        except OperationalError as e:
+            if "lock timeout" not in str(e) or attempt == SWAP_RETRIES:
+                raise
+            print(f"Could not acquire lock on {target_table} (attempt {attempt}/{SWAP_RETRIES}). Retrying...")
+            time.sleep(SWAP_RETRY_DELAY_SECONDS)
+
+
+def list_snapshots(engine):
+    """登録済みのスナップショットを一覧表示します。"""
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            f'SELECT table_name, version, min_date, max_date, row_count, created_at '
+            f'FROM public."{config.TABLE_NAME_SNAPSHOTS}" ORDER BY table_name'
+        )).fetchall()
+    if not rows:
+        print("No snapshots registered.")
+        return
+    print("{:<35} {:<12} {:<12} {:<12} {:>12} {:<20}".format("Table", "Version", "From", "To", "Rows", "Created"))
+    print("-" * 110)
+    for row in rows:
+        print("{:<35} {:<12} {:<12} {:<12} {:>12} {:<20}".format(
+            row.table_name, row.version or "(default)", str(row.min_date), str(row.max_date),
+            row.row_count or 0, row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else ""))
+
+
+def main():
+    """コマンドライン引数を解釈して、スナップショットを作成します。"""
+    parser = argparse.ArgumentParser(description="Build a bulk-plan snapshot of stockdata without re-ingesting.")
+    subparsers = parser.add_subparsers(dest="command", required=True, help="Available commands")
+
+    parser_build = subparsers.add_parser("build", help="Build (or rebuild) a snapshot for a date range.")
+    parser_build.add_argument("start_date", help="Start date (YYYY-MM-DD).")
+    parser_build.add_argument("end_date", help="End date (YYYY-MM-DD).")
+    parser_build.add_argument("--version", help="Snapshot version (e.g. 2024; letters, digits and _, up to 20 characters). Omit to rebuild stockdata_fixed itself.")
+    parser_build.add_argument("--keep-old", action="store_true", help="Keep the replaced table instead of dropping it.")
+
+    subparsers.add_parser("list", help="List registered snapshots.")
+
+    args = parser.parse_args()
+
+    try:
+        engine = create_engine(config.DATABASE_URL)
+        # 登録情報テーブルが未作成の環境でも動くようにする
+        create_tables(engine)
+
+        if args.command == "list":
+            list_snapshots(engine)
+            return
+
+        start_date = datetime.strptime(args.start_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(args.end_date, "%Y-%m-%d").date()
+        target_table = fixed_table_name(args.version)
+        build_table = f"build_{target_table}" # stockdata_fixed_<版> と重ならない名前にする
+
+        start_time = time.time()
+        try:
+            row_count, min_date, max_date = build_snapshot_table(engine, build_table, start_date, end_date)
+            if not row_count:
+                print("No rows in the requested range. Aborting without swapping.")
+                return
+            old_table = swap_in(engine, build_table, target_table, args.version, row_count, min_date, max_date)
+        finally:
+            with engine.begin() as connection:
+                connection.execute(text(f'DROP TABLE IF EXISTS public."{build_table}"'))
+
+        if old_table and not args.keep_old:
+            with engine.begin() as connection:
+                connection.execute(text(f'DROP TABLE IF EXISTS public."{old_table}"'))
+            print(f"Dropped previous table {old_table}.")
+        elif old_table:
+            print(f"Previous table kept as {old_table}.")
+        print(f"Snapshot ready in {time.time() - start_time:.2f} seconds.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    main()
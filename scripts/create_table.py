@@ -1,8 +1,9 @@
 # scripts/create_table.py
 
 import os
+import re
 import sys
-from sqlalchemy import create_engine, text, inspect, Table, Column, String, MetaData, Date, Float, BigInteger, Boolean, DateTime
+from sqlalchemy import create_engine, text, inspect, Table, Column, String, MetaData, Date, Float, BigInteger, Integer, Boolean, DateTime
 from sqlalchemy.sql import func
 
 # このスクリプトの親ディレクトリ(/app)を検索パスに追加
@@ -11,12 +12,29 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 # configモジュールをインポート
 import config
 
+# build_fixed_snapshot.py が作る "old_<epoch>_stockdata_fixed_<版>_date_idx" などの名前が
+# PostgreSQL の識別子の上限 (63文字) に収まるよう、版は20文字までとする
+SNAPSHOT_VERSION_PATTERN = re.compile(r"^[0-9A-Za-z_]{1,20}$")
+
+def fixed_table_name(version=None):
+    """買い切りプランのスナップショット版からテーブル名を返す (版の指定なしは stockdata_fixed)"""
+    if not version:
+        return config.TABLE_NAME_FIXED
+    if not SNAPSHOT_VERSION_PATTERN.match(version):
+        raise ValueError(f"Invalid snapshot version: {version!r}")
+    return f"{config.TABLE_NAME_FIXED}_{version.lower()}"
+
 def create_tables(engine):
     """
     アプリケーションに必要な全てのテーブルを作成します。
     - stockdata: 日次更新データ
     - stockdata_fixed: 期間固定の買い切りデータ
     - tokens: 認証トークン
+    - fixed_snapshots: 買い切りプラン用スナップショットの登録情報
+    - tokens_archive: 期限切れで削除したトークンの保管先
+    - stockdata_quarantine: 取り込み時の検証で除外した行
+    - stockdata_latest / stockdata_weekly / stockdata_monthly / stockdata_coverage:
+      日次更新データの集計 (銘柄ごとの最新日足・週足・月足・収録期間)
     """
     try:
         # メタデータを定義
@@ -66,16 +84,120 @@ def create_tables(engine):
             Column('user_email', String(255)),
             Column('expires_at', Date), # 削除設定日
             Column('is_active', Boolean, default=True, nullable=False),
+            Column('created_at', DateTime, server_default=func.now()),
+            Column('snapshot_version', String(50)) # 買い切りプランの参照先スナップショット (NULLなら stockdata_fixed)
+        )
+
+        # --- 4. fixed_snapshots テーブル (スナップショット登録情報) ---
+        Table(
+            config.TABLE_NAME_SNAPSHOTS, metadata, # "fixed_snapshots"
+            Column('table_name', String(63), primary_key=True),
+            Column('version', String(50)),
+            Column('min_date', Date, nullable=False),
+            Column('max_date', Date, nullable=False),
+            Column('row_count', BigInteger),
             Column('created_at', DateTime, server_default=func.now())
         )
 
+        # --- 5. stockdata_quarantine テーブル (検証で除外した行) ---
+        Table(
+            config.TABLE_NAME_QUARANTINE, metadata, # "stockdata_quarantine"
+            Column("証券コード", String(10), index=True),
+            Column("銘柄名", String(255)),
+            Column("日付", Date),
+            Column("始値", Float),
+            Column("高値", Float),
+            Column("安値", Float),
+            Column("終値", Float),
+            Column("始値（調整後）", Float),
+            Column("高値（調整後）", Float),
+            Column("安値（調整後）", Float),
+            Column("終値（調整後）", Float),
+            Column("出来高", BigInteger),
+            Column("検出理由", String(255)),
+            Column("検出日時", DateTime, server_default=func.now())
+        )
+
+        # --- 6. tokens_archive テーブル (期限切れトークンの保管用) ---
+        Table(
+            'tokens_archive', metadata,
+            Column('id', BigInteger, primary_key=True, autoincrement=False),
+            Column('token', String(255), nullable=False),
+            Column('plan_type', String(50), nullable=False),
+            Column('user_name', String(255)),
+            Column('user_email', String(255)),
+            Column('expires_at', Date),
+            Column('is_active', Boolean, nullable=False),
+            Column('created_at', DateTime),
+            Column('snapshot_version', String(50)),
+            Column('archived_at', DateTime, server_default=func.now())
+        )
+
+        # --- 7. stockdata_latest テーブル (銘柄ごとの最新の日足) ---
+        Table(
+            config.TABLE_NAME_LATEST, metadata, # "stockdata_latest"
+            Column("証券コード", String(10), primary_key=True),
+            Column("銘柄名", String(255)),
+            Column("日付", Date),
+            Column("始値", Float),
+            Column("高値", Float),
+            Column("安値", Float),
+            Column("終値", Float),
+            Column("始値（調整後）", Float),
+            Column("高値（調整後）", Float),
+            Column("安値（調整後）", Float),
+            Column("終値（調整後）", Float),
+            Column("出来高", BigInteger)
+        )
+
+        # --- 8. stockdata_weekly / stockdata_monthly テーブル (週足・月足) ---
+        for bar_table_name in (config.TABLE_NAME_WEEKLY, config.TABLE_NAME_MONTHLY):
+            Table(
+                bar_table_name, metadata,
+                Column("証券コード", String(10), primary_key=True),
+                Column("期間開始日", Date, primary_key=True),
+                Column("銘柄名", String(255)),
+                Column("期間終了日", Date), # 期間内の最終取引日
+                Column("始値", Float),
+                Column("高値", Float),
+                Column("安値", Float),
+                Column("終値", Float),
+                Column("始値（調整後）", Float),
+                Column("高値（調整後）", Float),
+                Column("安値（調整後）", Float),
+                Column("終値（調整後）", Float),
+                Column("出来高", BigInteger),
+                Column("日数", Integer) # 期間内の取引日数
+            )
+
+        # --- 9. stockdata_coverage テーブル (銘柄ごとの収録期間) ---
+        Table(
+            config.TABLE_NAME_COVERAGE, metadata, # "stockdata_coverage"
+            Column("証券コード", String(10), primary_key=True),
+            Column("開始日", Date),
+            Column("終了日", Date),
+            Column("日数", BigInteger)
+        )
+
         # データベースにテーブルを作成する（存在しない場合のみ）
         print("Executing CREATE ALL TABLES statement...")
         metadata.create_all(engine, checkfirst=True)
+
+        # 既存の tokens テーブルに後から追加したカラムを反映する
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE public.tokens ADD COLUMN IF NOT EXISTS snapshot_version VARCHAR(50)'))
+            # 管理画面の一覧 (作成日時の新しい順のキーセットページング) と絞り込み用のインデックス
+            connection.execute(text('CREATE INDEX IF NOT EXISTS tokens_created_at_id_idx ON public.tokens (created_at DESC, id DESC)'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS tokens_plan_type_created_at_idx ON public.tokens (plan_type, created_at DESC, id DESC)'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS tokens_expires_at_idx ON public.tokens (expires_at)'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS tokens_user_email_lower_idx ON public.tokens (lower(user_email) text_pattern_ops)'))
         
         # テーブルが存在するかを再確認
         inspector = inspect(engine)
-        required_tables = [config.TABLE_NAME, config.TABLE_NAME_FIXED, 'tokens']
+        required_tables = [
+            config.TABLE_NAME, config.TABLE_NAME_FIXED, 'tokens', config.TABLE_NAME_SNAPSHOTS, 'tokens_archive', config.TABLE_NAME_QUARANTINE,
+            config.TABLE_NAME_LATEST, config.TABLE_NAME_WEEKLY, config.TABLE_NAME_MONTHLY, config.TABLE_NAME_COVERAGE
+        ]
         existing_tables = inspector.get_table_names()
         
         all_ok = True
@@ -0,0 +1,214 @@
+# scripts/data_validation.py
+
+import numpy as np
+import pandas as pd
+
+# ====================================================================
+# 1. 検証パラメータ
+# ====================================================================
+
+PRICE_TOLERANCE = 0.011 # 小数第2位への丸め誤差を許容する
+# 東証の制限値幅 (基準値段がこの値段未満のときの値幅、円)。最後の値幅はそれ以上の値段に適用する
+PRICE_LIMIT_TABLE = (
+    (100, 30), (200, 50), (500, 80), (700, 100), (1000, 150), (1500, 300), (2000, 400), (3000, 500),
+    (5000, 700), (7000, 1000), (10000, 1500), (15000, 3000), (20000, 4000), (30000, 5000), (50000, 7000),
+    (70000, 10000), (100000, 15000), (150000, 30000), (200000, 40000), (300000, 50000), (500000, 70000),
+    (700000, 100000), (1000000, 150000), (1500000, 300000), (2000000, 400000), (3000000, 500000),
+    (5000000, 700000), (7000000, 1000000), (10000000, 1500000), (15000000, 3000000), (20000000, 4000000),
+    (30000000, 5000000), (50000000, 7000000), (None, 10000000),
+)
+PRICE_LIMIT_MARGIN = 1.1 # 基準値段と前日終値のずれ (配当落ちなど) を許容する
+SPLIT_RATIOS = (2, 3, 4, 5, 10, 20, 25, 50, 100) # よくある株式分割 (併合は逆数) の比率
+SPLIT_MATCH_TOLERANCE = 0.03
+CALENDAR_COVERAGE = 0.5 # 半数以上の銘柄にデータがある日を取引日とみなす
+CALENDAR_MIN_TICKERS = 10 # これより少ない銘柄数では取引日カレンダーを推定しない
+
+REASON_COLUMN = "検出理由"
+
+
+# ====================================================================
+# 2. 関数定義
+# ====================================================================
+
+def near_split_ratio(ratio):
+    """比率 (またはその逆数) が一般的な分割比率に近いかどうかを返す。"""
+    ratio = np.asarray(ratio, dtype=float)
+    with np.errstate(divide="ignore"):
+        inverted = np.where(ratio < 1, 1 / ratio, ratio)
+    candidates = np.array(SPLIT_RATIOS, dtype=float)
+    return (np.abs(inverted[:, None] / candidates[None, :] - 1) < SPLIT_MATCH_TOLERANCE).any(axis=1)
+
+
+def price_limit(base_price):
+    """基準値段 (前日の未調整終値) に対する東証の制限値幅 (円) を返す。"""
+    bounds = np.array([bound for bound, _ in PRICE_LIMIT_TABLE[:-1]], dtype=float)
+    limits = np.array([limit for _, limit in PRICE_LIMIT_TABLE], dtype=float)
+    base_price = np.asarray(base_price, dtype=float)
+    return limits[np.searchsorted(bounds, np.nan_to_num(base_price), side="right")]
+
+
+def is_large_move(ratio, base_price):
+    """前日比 (当日 / 前日) が、基準値段の制限値幅 (に余裕を持たせた幅) を超えているかを返す (NaN は False)。"""
+    ratio = np.asarray(ratio, dtype=float)
+    base_price = np.asarray(base_price, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        allowed = price_limit(base_price) * PRICE_LIMIT_MARGIN / base_price
+        return np.abs(ratio - 1) > allowed
+
+
+def previous_closes(history):
+    """証券コード・日付・終値を持つ行から、銘柄ごとの最新の終値を Series で返す。
+
+    同じ日付の行が複数ある場合は後ろの行を優先する。隔離テーブルの行も渡すことで、
+    隔離された急変後の価格を次回の比較基準にし、同じ銘柄が隔離され続けないようにする。
+    """
+    if history.empty:
+        return pd.Series(dtype="float64")
+    latest = history.sort_values("日付", kind="stable").groupby("証券コード", sort=False).last()
+    return latest["終値"].astype("float64").rename(index=str)
+
+
+def factorize_keys(df):
+    """証券コードと日付を整数コードに変換し、(code_ids, codes, day_ids, days, order) を返す。
+
+    days は昇順で、day_ids はその位置。order は (証券コード, 日付) 順に並べる行番号 (安定ソート)。
+    object 型の列の factorize は重いため、検証全体でこの結果を使い回す。
+    """
+    code_ids, codes = pd.factorize(df["証券コード"])
+    day_ids, days = pd.factorize(df["日付"], sort=True)
+    order = np.lexsort((day_ids, code_ids))
+    return code_ids, codes, day_ids, days, order
+
+
+def check_price_jumps(df, prev_close=None, keys=None):
+    """前日比の急変を検出し、(price_jump, split_mismatch) のマスクを df の行順で返す。
+
+    - チャンク内の連続する行は調整後終値で比較する。調整後の系列に分割比率と同じ大きさの
+      段差がある場合は、分割の二重適用・適用漏れとみなして split_mismatch とする。
+    - 各銘柄の最初の行は prev_close (DB上の直前の未調整終値) と比較する。未調整値なので
+      分割比率と一致する段差は正常とみなす。
+    - 許容する変動幅は、前日の未調整終値を基準値段とした東証の制限値幅から求める。
+    """
+    code_ids, codes, _, _, order = keys if keys is not None else factorize_keys(df)
+    sorted_codes = code_ids[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+
+    adjusted = df["終値（調整後）"].to_numpy(dtype=float)[order]
+    unadjusted = df["終値"].to_numpy(dtype=float)[order]
+    prev_adjusted = np.roll(adjusted, 1)
+    prev_unadjusted = np.roll(unadjusted, 1)
+    prev_adjusted[is_first] = np.nan
+    prev_unadjusted[is_first] = np.nan
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = adjusted / prev_adjusted
+    # 分割比率に近い段差は、値幅の判定とは別に調べる (1:2 分割の 0.5 倍が下落の閾値と重なるため)
+    split_like = np.zeros(len(order), dtype=bool)
+    split_like[~is_first] = near_split_ratio(ratio[~is_first])
+    split_mismatch = split_like
+    price_jump = is_large_move(ratio, prev_unadjusted) & ~split_like
+
+    if prev_close is not None and len(prev_close):
+        boundary_base = prev_close.reindex(codes.astype(str)).to_numpy(dtype=float)[sorted_codes]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            boundary_ratio = unadjusted / boundary_base
+        boundary_large = is_first & is_large_move(boundary_ratio, boundary_base)
+        if boundary_large.any():
+            boundary_split = np.zeros(len(order), dtype=bool)
+            boundary_split[boundary_large] = near_split_ratio(boundary_ratio[boundary_large])
+            price_jump |= boundary_large & ~boundary_split
+
+    # 元の行順に戻す
+    result_jump = np.empty(len(order), dtype=bool)
+    result_split = np.empty(len(order), dtype=bool)
+    result_jump[order] = price_jump
+    result_split[order] = split_mismatch
+    return result_jump, result_split
+
+
+def count_missing_trading_days(df, keys=None):
+    """チャンク内のデータから取引日カレンダーを推定し、銘柄ごとの欠損日数を返す。
+
+    祝日を含む取引所カレンダーの外部ライブラリに依存しないよう、同じチャンクの銘柄の
+    過半数にデータがある日を取引日とみなす。各銘柄の最初と最後の日付の間で、
+    取引日なのにデータがない日数を数える。
+    """
+    code_ids, codes, day_ids, days, order = keys if keys is not None else factorize_keys(df)
+    n_tickers = len(codes)
+    if n_tickers < CALENDAR_MIN_TICKERS:
+        return pd.Series(dtype="int64")
+
+    # (証券コード, 日付) の重複を除いた組を、証券コード・日付順に並べる
+    pairs = code_ids[order].astype(np.int64) * len(days) + day_ids[order]
+    pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+    pair_codes, pair_days = pairs // len(days), pairs % len(days)
+
+    calendar = np.bincount(pair_days, minlength=len(days)) / n_tickers >= CALENDAR_COVERAGE
+    if not calendar.any():
+        return pd.Series(dtype="int64")
+    calendar_count = np.cumsum(calendar) # 各日付までの取引日数
+
+    starts = np.flatnonzero(np.concatenate(([True], pair_codes[1:] != pair_codes[:-1])))
+    ends = np.concatenate((starts[1:], [len(pairs)])) - 1
+    first, last = pair_days[starts], pair_days[ends]
+    expected = calendar_count[last] - calendar_count[first] + calendar[first]
+    observed = np.bincount(pair_codes[calendar[pair_days]], minlength=n_tickers)[pair_codes[starts]]
+    missing = pd.Series(np.clip(expected - observed, 0, None), index=codes[pair_codes[starts]])
+    return missing[missing > 0]
+
+
+def validate_rows(df, prev_close=None):
+    """処理済みデータを検証し、(正常な行, 隔離する行, レポート) を返す。
+
+    隔離する行には検出理由 (カンマ区切り) の列が付く。prev_close は
+    証券コード → DB上の直前の未調整終値 の Series (なければ None)。
+    """
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return df, df.assign(**{REASON_COLUMN: pd.Series(dtype=object)}), {"rows": 0, "quarantined": 0, "reasons": {}}
+
+    open_ = df["始値"].to_numpy(dtype=float)
+    high = df["高値"].to_numpy(dtype=float)
+    low = df["安値"].to_numpy(dtype=float)
+    close = df["終値"].to_numpy(dtype=float)
+    volume = df["出来高"].to_numpy()
+
+    keys = factorize_keys(df)
+    code_ids, _, day_ids, days, _ = keys
+
+    checks = {}
+    # 1. 四本値の整合性 (高値 ≥ max(始値, 終値)、安値 ≤ min(始値, 終値)、価格 > 0)
+    checks["ohlc_inconsistent"] = (
+        (high + PRICE_TOLERANCE < np.maximum(open_, close))
+        | (low - PRICE_TOLERANCE > np.minimum(open_, close))
+        | (np.minimum.reduce([open_, high, low, close]) <= 0)
+    )
+    # 2. 出来高ゼロなのに値動きがある (値付かずの日は四本値がすべて同じになる)
+    checks["zero_volume"] = (volume == 0) & (high - low > PRICE_TOLERANCE)
+    # 3. 前日比の急変 (分割を考慮)
+    checks["price_jump"], checks["split_mismatch"] = check_price_jumps(df, prev_close, keys)
+    # 4. キーの重複 (最後の行を残す。重複したままだと ON CONFLICT DO UPDATE が失敗する)
+    pair_ids = pd.Series(code_ids.astype(np.int64) * len(days) + day_ids)
+    checks["duplicate_key"] = pair_ids.duplicated(keep="last").to_numpy()
+
+    bad = np.zeros(len(df), dtype=bool)
+    for mask in checks.values():
+        bad |= mask
+
+    quarantined = df[bad].copy()
+    if not quarantined.empty:
+        reason = pd.Series("", index=quarantined.index)
+        for name, mask in checks.items():
+            reason = reason + np.where(mask[bad], name + ",", "")
+        quarantined[REASON_COLUMN] = reason.str.rstrip(",")
+
+    missing = count_missing_trading_days(df, keys)
+    report = {
+        "rows": len(df),
+        "quarantined": int(bad.sum()),
+        "reasons": {name: int(mask.sum()) for name, mask in checks.items() if mask.any()},
+        "missing_trading_days": int(missing.sum()),
+        "tickers_with_missing_days": int(len(missing)),
+    }
+    return df[~bad], quarantined, report
@@ -4,120 +4,327 @@ import os
 import sys
 import argparse
 import secrets
-from sqlalchemy import create_engine, text, select, insert, update
-from sqlalchemy.orm import sessionmaker
+import csv
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, text, select, insert, update, and_, or_, not_, func, tuple_
 
 # このスクリプトの親ディレクトリ(/app)を検索パスに追加
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import config
 # create_table.py から MetaData クラスをインポートしてテーブル定義を再利用する
-from scripts.create_table import MetaData
+from scripts.create_table import MetaData, fixed_table_name
+
+PLAN_TYPES = ['bulk', 'subscription', 'trial']
+PAGE_SIZE = 50
+PURGE_BATCH_SIZE = 1000
+PURGE_GRACE_DAYS = 30 # 有効期限からこの日数が過ぎたトークンを削除 (アーカイブ) する
+
+# tokens と tokens_archive で共通のカラム
+TOKEN_COLUMNS = ['id', 'token', 'plan_type', 'user_name', 'user_email', 'expires_at', 'is_active', 'created_at', 'snapshot_version']
 
 def generate_token():
     """安全なランダムトークンを生成します。"""
     return secrets.token_hex(16)
 
-def add_token(engine, plan_type):
+def get_tokens_table(engine):
+    """tokens テーブルの定義をDBから読み込みます。"""
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=['tokens'])
+    return metadata.tables['tokens']
+
+# --------------------------------------------------------------------
+# 一覧・検索 (管理画面 src/app.py からも利用する)
+# --------------------------------------------------------------------
+
+def token_filters(tokens_table, plan_type=None, status=None, email=None, created_from=None, created_to=None):
+    """一覧の絞り込み条件 (WHERE句) のリストを作成します。
+
+    status は 'active' (有効かつ期限内) / 'expired' (無効化済みまたは期限切れ)。
+    email は前方一致 (大文字小文字を区別しない) で、lower(user_email) のインデックスを使う。
+    """
+    conditions = []
+    if plan_type:
+        conditions.append(tokens_table.c.plan_type == plan_type)
+    if status in ('active', 'expired'):
+        is_valid = and_(
+            tokens_table.c.is_active == True,
+            or_(tokens_table.c.expires_at.is_(None), tokens_table.c.expires_at >= date.today())
+        )
+        conditions.append(is_valid if status == 'active' else not_(is_valid))
+    if email:
+        pattern = email.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append(func.lower(tokens_table.c.user_email).like(pattern, escape='\\'))
+    if created_from:
+        conditions.append(tokens_table.c.created_at >= created_from)
+    if created_to:
+        conditions.append(tokens_table.c.created_at < created_to + timedelta(days=1))
+    return conditions
+
+def encode_cursor(row):
+    """次ページの開始位置 (最後に表示した行の作成日時とID) を文字列にします。"""
+    return f"{row.created_at.isoformat()}_{row.id}"
+
+def decode_cursor(cursor):
+    created_at, token_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(created_at), int(token_id)
+
+def search_tokens(connection, tokens_table, conditions, cursor=None, limit=PAGE_SIZE):
+    """作成日時の新しい順に1ページ分のトークンを返します (キーセット方式)。
+
+    戻り値は (行のリスト, 次ページのカーソル)。最終ページではカーソルは None。
+    """
+    stmt = select(tokens_table).where(*conditions)
+    if cursor:
+        created_at, token_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(tokens_table.c.created_at, tokens_table.c.id) < tuple_(created_at, token_id))
+    stmt = stmt.order_by(tokens_table.c.created_at.desc(), tokens_table.c.id.desc()).limit(limit + 1)
+    rows = connection.execute(stmt).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+# --------------------------------------------------------------------
+# 一括操作
+# --------------------------------------------------------------------
+
+def check_snapshot_version(connection, snapshot_version):
+    """買い切りプランの版が build_fixed_snapshot.py で作成済みかを確認します。
+
+    版の形式が不正、または未登録の場合は ValueError を送出する (版の指定なしは stockdata_fixed)。
+    """
+    if not snapshot_version:
+        return
+    table_name = fixed_table_name(snapshot_version)
+    registered = connection.execute(
+        text(f'SELECT 1 FROM public."{config.TABLE_NAME_SNAPSHOTS}" WHERE table_name = :table_name'),
+        {"table_name": table_name}
+    ).first()
+    if not registered:
+        raise ValueError(f"Snapshot version {snapshot_version!r} has not been built (see build_fixed_snapshot.py list).")
+
+def issue_tokens(connection, tokens_table, entries):
+    """複数のトークンを1回の INSERT で発行し、発行した値のリストを返します。
+
+    entries は plan_type, user_name, user_email, expires_at, snapshot_version をキーに持つ辞書のリスト。
+    呼び出し側のトランザクション内で実行するため、全件発行されるか1件も発行されないかのどちらかになる。
+    買い切りプランの版が未作成の場合は ValueError を送出し、1件も発行しない。
+    """
+    for snapshot_version in {entry.get('snapshot_version') for entry in entries if entry['plan_type'] == 'bulk'}:
+        check_snapshot_version(connection, snapshot_version)
+
+    rows = []
+    for entry in entries:
+        rows.append({
+            'token': generate_token(),
+            'plan_type': entry['plan_type'],
+            'user_name': entry.get('user_name'),
+            'user_email': entry.get('user_email'),
+            'expires_at': entry.get('expires_at'),
+            'snapshot_version': entry.get('snapshot_version') if entry['plan_type'] == 'bulk' else None,
+            'is_active': True,
+        })
+    if rows:
+        connection.execute(insert(tokens_table), rows)
+    return rows
+
+def expire_tokens(connection, tokens_table, token_ids):
+    """指定IDのトークンをまとめて無効化し、更新件数を返します。"""
+    if not token_ids:
+        return 0
+    stmt = update(tokens_table).where(tokens_table.c.id.in_(token_ids)).values(is_active=False)
+    return connection.execute(stmt).rowcount
+
+def purge_expired_tokens(engine, grace_days=PURGE_GRACE_DAYS, batch_size=PURGE_BATCH_SIZE, archive=True):
+    """有効期限から grace_days 日以上過ぎたトークンを batch_size 件ずつ削除します。
+
+    archive=True の場合は削除した行を tokens_archive に移す。バッチごとにコミットするため、
+    件数が多くても長時間ロックを保持しない。削除した件数を返す。
+    """
+    cutoff = date.today() - timedelta(days=grace_days)
+    columns = ", ".join(TOKEN_COLUMNS)
+    target = """
+        DELETE FROM public.tokens
+        WHERE id IN (
+            SELECT id FROM public.tokens
+            WHERE expires_at < :cutoff
+            ORDER BY id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+    """
+    if archive:
+        sql = f"""
+        WITH moved AS ({target} RETURNING {columns})
+        INSERT INTO public.tokens_archive ({columns})
+        SELECT {columns} FROM moved
+        """
+    else:
+        sql = target
+
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            deleted = connection.execute(text(sql), {"cutoff": cutoff, "batch_size": batch_size}).rowcount
+        total += deleted
+        if deleted < batch_size:
+            break
+    return total
+
+# --------------------------------------------------------------------
+# コマンド
+# --------------------------------------------------------------------
+
+def add_token(engine, plan_type, snapshot_version=None):
     """新しいトークンをDBに追加します。"""
     new_token_str = generate_token()
-    
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
+
+    tokens_table = get_tokens_table(engine)
 
     try:
         with engine.connect() as connection:
-            stmt = insert(tokens_table).values(token=new_token_str, plan_type=plan_type, is_active=True)
+            check_snapshot_version(connection, snapshot_version)
+            stmt = insert(tokens_table).values(token=new_token_str, plan_type=plan_type, is_active=True,
+                                               snapshot_version=snapshot_version)
             connection.execute(stmt)
             connection.commit() # 変更をDBに確定させる
-        
+
         print("="*40)
         print("✅ New Token Generated Successfully!")
         print(f"  Plan: {plan_type}")
+        if snapshot_version:
+            print(f"  Snapshot: {snapshot_version}")
         print(f"  Token: {new_token_str}")
         print("="*40)
     except Exception as e:
         print(f"❌ Error adding token: {e}")
 
-def set_token_status(engine, token_str, is_active):
-    """指定されたトークンの有効/無効ステータスを設定します。"""
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
-    
+def add_tokens_bulk(engine, plan_type, csv_path=None, count=None, expires_at=None, snapshot_version=None):
+    """CSV (user_name,user_email) の行数分、または count 件のトークンを1トランザクションで発行します。"""
+    if csv_path:
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            entries = [{'user_name': row.get('user_name'), 'user_email': row.get('user_email')} for row in csv.DictReader(f)]
+    else:
+        entries = [{} for _ in range(count or 0)]
+    for entry in entries:
+        entry.update(plan_type=plan_type, expires_at=expires_at, snapshot_version=snapshot_version)
+
+    tokens_table = get_tokens_table(engine)
+    try:
+        with engine.begin() as connection:
+            rows = issue_tokens(connection, tokens_table, entries)
+        print(f"✅ {len(rows)} tokens issued ({plan_type}).")
+        print("user_name,user_email,token")
+        for row in rows:
+            print(f"{row['user_name'] or ''},{row['user_email'] or ''},{row['token']}")
+    except Exception as e:
+        print(f"❌ Error issuing tokens (no tokens were issued): {e}")
+
+def set_token_status(engine, token_strs, is_active):
+    """指定されたトークン (複数可) の有効/無効ステータスを設定します。"""
+    tokens_table = get_tokens_table(engine)
+
     status_str = "ACTIVATED" if is_active else "DEACTIVATED"
 
     try:
         with engine.connect() as connection:
-            stmt = update(tokens_table).where(tokens_table.c.token == token_str).values(is_active=is_active)
+            stmt = update(tokens_table).where(tokens_table.c.token.in_(token_strs)).values(is_active=is_active)
             result = connection.execute(stmt)
             connection.commit()
 
             if result.rowcount == 0:
-                print(f"❌ Error: Token '{token_str}' not found.")
+                print(f"❌ Error: Token(s) {', '.join(token_strs)} not found.")
             else:
-                print(f"✅ Token '{token_str}' has been {status_str}.")
+                print(f"✅ {result.rowcount} of {len(token_strs)} token(s) have been {status_str}.")
     except Exception as e:
         print(f"❌ Error updating token status: {e}")
 
-def list_tokens(engine):
-    """DBに登録されているすべてのトークンを一覧表示します。"""
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
-    
+def list_tokens(engine, limit=PAGE_SIZE, cursor=None, **filters):
+    """DBに登録されているトークンを、条件で絞り込んで1ページずつ一覧表示します。"""
+    tokens_table = get_tokens_table(engine)
+
     try:
         with engine.connect() as connection:
-            stmt = select(tokens_table).order_by(tokens_table.c.id)
-            results = connection.execute(stmt).fetchall()
-        
+            conditions = token_filters(tokens_table, **filters)
+            results, next_cursor = search_tokens(connection, tokens_table, conditions, cursor=cursor, limit=limit)
+
         if not results:
             print("No tokens found in the database.")
             return
 
-        print("{:<35} {:<15} {:<10}".format("Token", "Plan Type", "Is Active"))
-        print("-" * 65)
+        print("{:<35} {:<15} {:<10} {:<12} {:<30}".format("Token", "Plan Type", "Is Active", "Expires", "Email"))
+        print("-" * 105)
         for row in results:
             # rowオブジェクトから属性名で値を取得する
-            print("{:<35} {:<15} {:<10}".format(row.token, row.plan_type, str(row.is_active)))
+            print("{:<35} {:<15} {:<10} {:<12} {:<30}".format(
+                row.token, row.plan_type, str(row.is_active), str(row.expires_at or '-'), row.user_email or '-'))
+        if next_cursor:
+            print(f"\nMore tokens available. Next page: --cursor {next_cursor}")
     except Exception as e:
         print(f"❌ Error listing tokens: {e}")
 
+def _date_arg(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
 def main():
     """コマンドライン引数を解釈して、対応する関数を実行します。"""
     parser = argparse.ArgumentParser(description="Manage authentication tokens for StockData app.")
     subparsers = parser.add_subparsers(dest="command", required=True, help="Available commands")
 
     # 'add' コマンドの設定
-    parser_add = subparsers.add_parser("add", help="Add a new token.")
-    parser_add.add_argument("plan_type", choices=['bulk', 'subscription', 'trial'], help="The plan type for the new token ('bulk', 'subscription', or 'trial').")
+    parser_add = subparsers.add_parser("add", help="Add a new token (or many with --count / --csv).")
+    parser_add.add_argument("plan_type", choices=PLAN_TYPES, help="The plan type for the new token ('bulk', 'subscription', or 'trial').")
+    parser_add.add_argument("--snapshot", help="Bulk plan only: snapshot version built by build_fixed_snapshot.py (default: stockdata_fixed).")
+    parser_add.add_argument("--count", type=int, help="Issue this many tokens in one transaction.")
+    parser_add.add_argument("--csv", help="Issue one token per row of a CSV with user_name,user_email columns, in one transaction.")
+    parser_add.add_argument("--expires-at", type=_date_arg, help="Expiry date for bulk-issued tokens (YYYY-MM-DD).")
 
     # 'deactivate' コマンドの設定
-    parser_deactivate = subparsers.add_parser("deactivate", help="Deactivate a token.")
-    parser_deactivate.add_argument("token", help="The token string to deactivate.")
-    
+    parser_deactivate = subparsers.add_parser("deactivate", help="Deactivate (expire) one or more tokens.")
+    parser_deactivate.add_argument("token", nargs="+", help="The token string(s) to deactivate.")
+
     # 'activate' コマンドの設定
-    parser_activate = subparsers.add_parser("activate", help="Reactivate a token.")
-    parser_activate.add_argument("token", help="The token string to activate.")
+    parser_activate = subparsers.add_parser("activate", help="Reactivate one or more tokens.")
+    parser_activate.add_argument("token", nargs="+", help="The token string(s) to activate.")
 
     # 'list' コマンドの設定
-    subparsers.add_parser("list", help="List all tokens in the database.")
+    parser_list = subparsers.add_parser("list", help="List tokens, newest first, one page at a time.")
+    parser_list.add_argument("--plan-type", choices=PLAN_TYPES)
+    parser_list.add_argument("--status", choices=['active', 'expired'])
+    parser_list.add_argument("--email", help="Email prefix (case-insensitive).")
+    parser_list.add_argument("--created-from", type=_date_arg, help="YYYY-MM-DD")
+    parser_list.add_argument("--created-to", type=_date_arg, help="YYYY-MM-DD")
+    parser_list.add_argument("--limit", type=int, default=PAGE_SIZE)
+    parser_list.add_argument("--cursor", help="Cursor printed at the end of the previous page.")
+
+    # 'purge' コマンドの設定 (cron などで定期実行する)
+    parser_purge = subparsers.add_parser("purge", help="Delete tokens expired more than --grace-days ago, in batches (run periodically).")
+    parser_purge.add_argument("--grace-days", type=int, default=PURGE_GRACE_DAYS)
+    parser_purge.add_argument("--batch-size", type=int, default=PURGE_BATCH_SIZE)
+    parser_purge.add_argument("--no-archive", action="store_true", help="Delete without copying to tokens_archive.")
 
     args = parser.parse_args()
-    
+
     try:
         engine = create_engine(config.DATABASE_URL)
 
         if args.command == "add":
-            add_token(engine, args.plan_type)
+            snapshot_version = args.snapshot if args.plan_type == 'bulk' else None
+            if args.count or args.csv:
+                add_tokens_bulk(engine, args.plan_type, csv_path=args.csv, count=args.count,
+                                expires_at=args.expires_at, snapshot_version=snapshot_version)
+            else:
+                add_token(engine, args.plan_type, snapshot_version)
         elif args.command == "deactivate":
             set_token_status(engine, args.token, is_active=False)
         elif args.command == "activate":
             set_token_status(engine, args.token, is_active=True)
         elif args.command == "list":
-            list_tokens(engine)
+            list_tokens(engine, limit=args.limit, cursor=args.cursor, plan_type=args.plan_type, status=args.status,
+                        email=args.email, created_from=args.created_from, created_to=args.created_to)
+        elif args.command == "purge":
+            deleted = purge_expired_tokens(engine, args.grace_days, args.batch_size, archive=not args.no_archive)
+            print(f"✅ {deleted} expired token(s) purged{'' if args.no_archive else ' (archived to tokens_archive)'}.")
     except Exception as e:
         print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
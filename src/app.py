@@ -1,15 +1,19 @@
 # src/app.py
 
 import os
+import time
 import secrets
 from flask import Flask, render_template, request, Response, stream_with_context, jsonify, redirect, url_for, session
-from sqlalchemy import create_engine, text, select, insert, update, delete
+from sqlalchemy import create_engine, text, select, insert, update, delete, MetaData
+from sqlalchemy.exc import InvalidRequestError
 from datetime import datetime, date
 from io import StringIO
 import csv
 import config
+import metrics
 
-from scripts.create_table import MetaData
+from scripts.create_table import fixed_table_name
+from scripts.manage_tokens import token_filters, search_tokens, issue_tokens, expire_tokens, check_snapshot_version
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "fallback-secret-key-for-admin")
@@ -18,33 +22,80 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY", "fallback-secret-key-for-admin")
 def inject_now():
     return {'now_date': date.today}
 
+_engine = None
+_tables = {}
+_in_master = False # preload_app でマスターが状態を準備している間は True
+
 def get_db_engine():
-    """データベースエンジンを返す"""
-    return create_engine(config.DATABASE_URL)
+    """データベースエンジンを返す (ワーカー内で共有し、コネクションプールを再利用する)"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(config.DATABASE_URL)
+        metrics.instrument_pool(_engine)
+        # マスターはリクエストを処理せず、pid も dead にならないため、プールサイズは
+        # ワーカー (reset_after_fork) でのみ設定する (livesum に余分なプールが加算されないように)
+        if not _in_master:
+            metrics.DB_POOL_SIZE.set(_engine.pool.size())
+    return _engine
+
+def get_table(name):
+    """テーブル定義を返す。reflect はプロセス内で1回だけ行い、存在しない場合は None を返す"""
+    table = _tables.get(name)
+    if table is None:
+        metadata = MetaData()
+        try:
+            metadata.reflect(bind=get_db_engine(), only=[name])
+        except InvalidRequestError:
+            return None
+        table = _tables[name] = metadata.tables[name]
+    return table
+
+def init_app_state():
+    """エンジンとテーブル定義を準備する (gunicorn の preload_app 時にマスターで1回だけ呼び出す)"""
+    global _in_master
+    _in_master = True
+    try:
+        get_table('tokens')
+        get_table(config.TABLE_NAME_SNAPSHOTS)
+        print("Application state initialized.")
+    except Exception as e:
+        # DBの起動が間に合わない場合は、各ワーカーで最初のリクエスト時に準備する
+        print(f"Could not initialize application state: {e}")
+    finally:
+        _in_master = False
 
+def reset_after_fork():
+    """フォーク後のワーカーで呼び出し、マスターのDBコネクションを引き継がないようにする"""
+    if _engine is not None:
+        _engine.dispose(close=False)
+        metrics.DB_POOL_SIZE.set(_engine.pool.size())
+
+@metrics.TOKEN_VALIDATION_SECONDS.time()
 def validate_token(token_str):
     """トークンを検証し、(プランタイプ, テーブル名) を返す"""
     if not token_str:
         return None, None
     engine = get_db_engine()
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
+    tokens_table = get_table('tokens')
     with engine.connect() as connection:
-        stmt = select(tokens_table.c.plan_type, tokens_table.c.expires_at).where(
+        stmt = select(tokens_table.c.plan_type, tokens_table.c.expires_at, tokens_table.c.snapshot_version).where(
             tokens_table.c.token == token_str,
             tokens_table.c.is_active == True
         )
         row = connection.execute(stmt).fetchone()
     
     if row:
-        plan_type, expires_at = row
+        plan_type, expires_at, snapshot_version = row
         # 有効期限のチェック
         if expires_at and expires_at < date.today():
             return None, None
             
         if plan_type == 'bulk':
-            return 'bulk', config.TABLE_NAME_FIXED
+            # トークンに版の指定があれば、そのスナップショットを参照する (解決できない版は無効なトークン扱い)
+            try:
+                return 'bulk', fixed_table_name(snapshot_version)
+            except ValueError:
+                return None, None
         elif plan_type == 'subscription':
             return 'subscription', config.TABLE_NAME
         elif plan_type == 'trial':
@@ -52,11 +103,20 @@ def validate_token(token_str):
             
     return None, None
 
-def get_bulk_plan_date_range(engine):
+def get_bulk_plan_date_range(engine, table_name=config.TABLE_NAME_FIXED):
     """買い切りプランの有効な日付範囲 (min, max) をDBから取得する"""
+    # build_fixed_snapshot.py で作成したスナップショットは登録情報から返し、全件スキャンを避ける
     try:
         with engine.connect() as connection:
-            query = text(f'SELECT MIN("日付"), MAX("日付") FROM public."{config.TABLE_NAME_FIXED}"')
+            query = text(f'SELECT min_date, max_date FROM public."{config.TABLE_NAME_SNAPSHOTS}" WHERE table_name = :table_name')
+            result = connection.execute(query, {"table_name": table_name}).fetchone()
+            if result and result[0] and result[1]:
+                return result[0], result[1]
+    except Exception as e:
+        print(f"Error fetching snapshot info for {table_name}: {e}")
+    try:
+        with engine.connect() as connection:
+            query = text(f'SELECT MIN("日付"), MAX("日付") FROM public."{table_name}"')
             result = connection.execute(query).fetchone()
             if result and result[0] and result[1]:
                 return result[0], result[1] # dateオブジェクトを返す
@@ -64,6 +124,19 @@ def get_bulk_plan_date_range(engine):
         print(f"Error fetching data range for bulk plan: {e}")
     return None, None
 
+def parse_tickers(value):
+    """カンマ・空白・改行区切りの証券コードをリストに変換する"""
+    if not value:
+        return []
+    return [t.strip() for t in value.replace(',', ' ').replace('\n', ' ').split() if t.strip()]
+
+def parse_date_arg(value):
+    """YYYY-MM-DD 形式の文字列を date に変換する (空・不正な値は None)"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -87,17 +160,39 @@ def admin():
     if not session.get('is_admin'):
         return render_template('admin.html', login_required=True)
 
+    # 絞り込み条件 (不正な日付は無視する)
+    filters = {
+        'plan_type': request.args.get('plan_type') or None,
+        'status': request.args.get('status') or None,
+        'email': (request.args.get('email') or '').strip() or None,
+        'created_from': parse_date_arg(request.args.get('created_from')),
+        'created_to': parse_date_arg(request.args.get('created_to')),
+    }
+    cursor = request.args.get('cursor') or None
+
     engine = get_db_engine()
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
+    tokens_table = get_table('tokens')
     
     with engine.connect() as connection:
-        # トークン一覧を取得
-        stmt = select(tokens_table).order_by(tokens_table.c.created_at.desc())
-        tokens = connection.execute(stmt).fetchall()
+        # トークン一覧を1ページ分だけ取得 (作成日時の新しい順、キーセット方式)
+        conditions = token_filters(tokens_table, **filters)
+        try:
+            tokens, next_cursor = search_tokens(connection, tokens_table, conditions, cursor=cursor)
+        except ValueError:
+            cursor = None
+            tokens, next_cursor = search_tokens(connection, tokens_table, conditions)
+        # 発行フォームで選択できる買い切りプランのスナップショット (版あり)
+        snapshots_table = get_table(config.TABLE_NAME_SNAPSHOTS)
+        snapshots = []
+        if snapshots_table is not None:
+            stmt = select(snapshots_table).where(snapshots_table.c.version.isnot(None)).order_by(snapshots_table.c.version)
+            snapshots = connection.execute(stmt).fetchall()
         
-    return render_template('admin.html', tokens=tokens)
+    # ページ移動用のリンクで絞り込み条件を引き継ぐ
+    query_args = {key: (value.isoformat() if isinstance(value, date) else value)
+                  for key, value in filters.items() if value}
+    return render_template('admin.html', tokens=tokens, snapshots=snapshots, filters=query_args,
+                           next_cursor=next_cursor, is_first_page=not cursor)
 
 @app.route('/admin/issue', methods=['POST'])
 def admin_issue():
@@ -108,6 +203,9 @@ def admin_issue():
     user_email = request.form.get('user_email')
     plan_type = request.form.get('plan_type')
     expires_at_str = request.form.get('expires_at')
+    snapshot_version = request.form.get('snapshot_version') or None
+    if plan_type != 'bulk':
+        snapshot_version = None
     
     expires_at = None
     if expires_at_str:
@@ -116,24 +214,77 @@ def admin_issue():
     new_token = secrets.token_hex(16)
     
     engine = get_db_engine()
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
+    tokens_table = get_table('tokens')
     
     with engine.connect() as connection:
+        try:
+            check_snapshot_version(connection, snapshot_version)
+        except ValueError as e:
+            return f"Error: {e}", 400
         stmt = insert(tokens_table).values(
             token=new_token,
             plan_type=plan_type,
             user_name=user_name,
             user_email=user_email,
             expires_at=expires_at,
-            is_active=True
+            is_active=True,
+            snapshot_version=snapshot_version
         )
         connection.execute(stmt)
         connection.commit()
         
     return redirect(url_for('admin'))
 
+@app.route('/admin/issue_bulk', methods=['POST'])
+def admin_issue_bulk():
+    """「氏名,メールアドレス」を1行ずつ入力し、まとめて発行する (1トランザクション)"""
+    if not session.get('is_admin'):
+        return "Unauthorized", 401
+
+    plan_type = request.form.get('plan_type')
+    expires_at = parse_date_arg(request.form.get('expires_at'))
+    snapshot_version = request.form.get('snapshot_version') or None
+
+    entries = []
+    for line in (request.form.get('entries') or '').splitlines():
+        if not line.strip():
+            continue
+        user_name, _, user_email = line.partition(',')
+        entries.append({
+            'plan_type': plan_type,
+            'user_name': user_name.strip() or None,
+            'user_email': user_email.strip() or None,
+            'expires_at': expires_at,
+            'snapshot_version': snapshot_version,
+        })
+
+    engine = get_db_engine()
+    tokens_table = get_table('tokens')
+
+    try:
+        with engine.begin() as connection:
+            issue_tokens(connection, tokens_table, entries)
+    except ValueError as e:
+        return f"Error: {e}", 400
+
+    return redirect(url_for('admin'))
+
+@app.route('/admin/expire', methods=['POST'])
+def admin_expire():
+    """選択したトークンをまとめて無効化する"""
+    if not session.get('is_admin'):
+        return "Unauthorized", 401
+
+    token_ids = [int(token_id) for token_id in request.form.getlist('token_ids') if token_id.isdigit()]
+
+    engine = get_db_engine()
+    tokens_table = get_table('tokens')
+
+    with engine.begin() as connection:
+        expire_tokens(connection, tokens_table, token_ids)
+
+    return redirect(url_for('admin'))
+
 @app.route('/admin/delete', methods=['POST'])
 def admin_delete():
     if not session.get('is_admin'):
@@ -142,9 +293,7 @@ def admin_delete():
     token_id = request.form.get('token_id')
     
     engine = get_db_engine()
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    tokens_table = metadata.tables['tokens']
+    tokens_table = get_table('tokens')
     
     with engine.connect() as connection:
         stmt = delete(tokens_table).where(tokens_table.c.id == token_id)
@@ -164,11 +313,11 @@ def admin_logout():
 def get_plan_info():
     """トークンに基づいてプラン情報を返す"""
     token = request.args.get('token')
-    plan_type, _ = validate_token(token)
+    plan_type, table_name = validate_token(token)
 
     if plan_type == 'bulk':
         engine = get_db_engine()
-        min_date, max_date = get_bulk_plan_date_range(engine)
+        min_date, max_date = get_bulk_plan_date_range(engine, table_name)
         if min_date and max_date:
             return jsonify({
                 "status": "success",
@@ -197,6 +346,12 @@ def get_plan_info():
     else:
         return jsonify({"status": "error", "message": "無効なトークンです。"}), 401
 
+# 週足・月足は集計テーブルから返す (日足は各プランのテーブル)
+INTERVAL_TABLES = {
+    'weekly': config.TABLE_NAME_WEEKLY,
+    'monthly': config.TABLE_NAME_MONTHLY,
+}
+
 @app.route('/download', methods=['POST'])
 def download():
     """トークンを検証し、株価データをCSVとしてストリーミングダウンロードします。"""
@@ -207,12 +362,23 @@ def download():
 
     start_date_str = request.form.get('start_date')
     end_date_str = request.form.get('end_date')
+    interval = request.form.get('interval') or 'daily'
+    date_column = "日付"
+
+    if interval != 'daily':
+        if interval not in INTERVAL_TABLES:
+            return "Error: interval must be one of daily, weekly, monthly.", 400
+        # 集計テーブルは日次更新データから作るため、期間が固定・限定されたプランでは使わない
+        if plan_type != 'subscription':
+            return "Error: Weekly and monthly data are available for the subscription plan only.", 400
+        table_name = INTERVAL_TABLES[interval]
+        date_column = "期間開始日"
     
     engine = get_db_engine()
 
     # 買い切りプランの場合、サーバーサイドで厳格な期間チェックを行う
     if plan_type == 'bulk':
-        min_valid_date, max_valid_date = get_bulk_plan_date_range(engine)
+        min_valid_date, max_valid_date = get_bulk_plan_date_range(engine, table_name)
         if not min_valid_date or not max_valid_date:
             return "Error: Could not determine valid date range for this plan.", 500
 
@@ -237,26 +403,27 @@ def download():
         start_date_str = "2025-01-01"
         end_date_str = "2025-01-07"
 
-    tickers_str = request.form.get('tickers')
+    tickers = parse_tickers(request.form.get('tickers'))
     base_query = f'SELECT * FROM public."{table_name}" WHERE 1=1'
     params = {}
 
-    if tickers_str:
-        tickers = [t.strip() for t in tickers_str.replace(',', ' ').replace('\n', ' ').split() if t.strip()]
-        if tickers:
-            base_query += ' AND "証券コード" IN :tickers'
-            params['tickers'] = tuple(tickers)
+    if tickers:
+        base_query += ' AND "証券コード" IN :tickers'
+        params['tickers'] = tuple(tickers)
     
     if start_date_str:
-        base_query += ' AND "日付" >= :start_date'
+        base_query += f' AND "{date_column}" >= :start_date'
         params['start_date'] = start_date_str
     if end_date_str:
-        base_query += ' AND "日付" <= :end_date'
+        base_query += f' AND "{date_column}" <= :end_date'
         params['end_date'] = end_date_str
         
-    base_query += ' ORDER BY "証券コード", "日付"'
+    base_query += f' ORDER BY "証券コード", "{date_column}"'
 
     def generate_csv():
+        stream_start = time.perf_counter()
+        row_count = 0
+        byte_count = 0
         try:
             with engine.connect() as connection:
                 stream_result = connection.execution_options(stream_results=True).execute(text(base_query), params)
@@ -264,21 +431,83 @@ def download():
                 output = StringIO()
                 writer = csv.writer(output)
                 writer.writerow(header)
-                yield output.getvalue()
+                # バイト数を計測するため、ここでUTF-8にエンコードしてから返す
+                chunk = output.getvalue().encode('utf-8')
+                byte_count += len(chunk)
+                yield chunk
                 output.seek(0)
                 output.truncate(0)
                 for row in stream_result:
+                    if row_count == 0:
+                        metrics.QUERY_FIRST_ROW_SECONDS.labels(plan_type=plan_type).observe(time.perf_counter() - stream_start)
+                    row_count += 1
                     writer.writerow(row)
-                    yield output.getvalue()
+                    chunk = output.getvalue().encode('utf-8')
+                    byte_count += len(chunk)
+                    yield chunk
                     output.seek(0)
                     output.truncate(0)
         except Exception as e:
             yield f"Error: {e}"
             return
+        finally:
+            # クライアント切断 (GeneratorExit) の場合も計測値を記録する
+            metrics.DOWNLOAD_ROWS.labels(plan_type=plan_type).observe(row_count)
+            metrics.DOWNLOAD_BYTES.labels(plan_type=plan_type).observe(byte_count)
+            metrics.DOWNLOAD_STREAM_SECONDS.labels(plan_type=plan_type).observe(time.perf_counter() - stream_start)
 
     response = Response(stream_with_context(generate_csv()), mimetype='text/csv')
-    response.headers['Content-Disposition'] = 'attachment; filename=stock_data.csv'
+    filename = 'stock_data.csv' if interval == 'daily' else f'stock_data_{interval}.csv'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
     return response
 
+@app.route('/summary', methods=['GET'])
+def summary():
+    """銘柄ごとの最新の日足と収録期間を返す (サブスクリプションプランのみ)。
+
+    集計テーブル (stockdata_latest / stockdata_coverage) を参照するため、日足の全件走査は行わない。
+    """
+    token = request.args.get('token')
+    plan_type, _ = validate_token(token)
+    if not plan_type:
+        return jsonify({"status": "error", "message": "無効なトークンです。"}), 401
+    if plan_type != 'subscription':
+        return jsonify({"status": "error", "message": "サマリーはサブスクリプションプランでのみ利用できます。"}), 403
+
+    query = f'''
+        SELECT * FROM public."{config.TABLE_NAME_LATEST}"
+        LEFT JOIN public."{config.TABLE_NAME_COVERAGE}" USING ("証券コード")
+    '''
+    params = {}
+    tickers = parse_tickers(request.args.get('tickers'))
+    if tickers:
+        query += ' WHERE "証券コード" IN :tickers'
+        params['tickers'] = tuple(tickers)
+    query += ' ORDER BY "証券コード"'
+
+    with get_db_engine().connect() as connection:
+        rows = connection.execute(text(query), params).mappings().all()
+    data = [
+        {key: value.isoformat() if isinstance(value, date) else value for key, value in row.items()}
+        for row in rows
+    ]
+    return jsonify({"status": "success", "count": len(data), "data": data})
+
+# --- メトリクス ---
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 形式のメトリクスを返す (gunicorn 実行時は全ワーカーを集約)
+
+    公開ポートで提供しているため、METRICS_TOKEN を Bearer トークンとして送ったリクエストにのみ返す。
+    """
+    if not config.METRICS_TOKEN:
+        return "Not Found", 404
+    expected = f"Bearer {config.METRICS_TOKEN}"
+    if not secrets.compare_digest(request.headers.get('Authorization', '').encode(), expected.encode()):
+        return "Unauthorized", 401
+    body, content_type = metrics.render_latest()
+    return Response(body, content_type=content_type)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,19 +1,32 @@
 # config.py
 
 import os
-from sqlalchemy.engine.url import URL
-from dotenv import load_dotenv
 
 # プロジェクトルートにある .env ファイルの内容を環境変数として読み込む
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+# (Docker では env_file で渡されるため、ファイルがない場合は python-dotenv の読み込み自体を省く)
+DOTENV_PATH = os.path.join(os.path.dirname(__file__), '..', '.env')
+if os.path.exists(DOTENV_PATH):
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=DOTENV_PATH)
 
 
 # --- 基本設定 ---
 TABLE_NAME = "stockdata"
 TABLE_NAME_FIXED = "stockdata_fixed"
+TABLE_NAME_SNAPSHOTS = "fixed_snapshots"
+TABLE_NAME_QUARANTINE = "stockdata_quarantine"
+TABLE_NAME_LATEST = "stockdata_latest"
+TABLE_NAME_WEEKLY = "stockdata_weekly"
+TABLE_NAME_MONTHLY = "stockdata_monthly"
+TABLE_NAME_COVERAGE = "stockdata_coverage"
 TICKER_CSV_FILE = "data/tickers.csv"
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin")
 
+# ローダーのメトリクスを書き出す textfile collector 用ファイル (未設定なら出力しない)
+LOADER_METRICS_TEXTFILE = os.getenv("LOADER_METRICS_TEXTFILE")
+# /metrics の取得に必要なトークン (Authorization: Bearer <トークン>)。未設定なら /metrics は公開しない
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 
 # --- VPS (Docker) 環境用の接続設定 ---
 # .envファイルから読み込まれた環境変数を取得
@@ -0,0 +1,37 @@
+# gunicorn.conf.py
+
+import os
+import shutil
+
+# 前回実行分のメトリクスファイルを削除し、ディレクトリを作り直す。
+# preload_app ではマスターが on_starting より前にアプリ (prometheus_client) を import し、
+# その時点でこのディレクトリにファイルを開くため、設定ファイルの読み込み時に行う
+_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if _multiproc_dir:
+    shutil.rmtree(_multiproc_dir, ignore_errors=True)
+    os.makedirs(_multiproc_dir, exist_ok=True)
+
+bind = "0.0.0.0:5000"
+
+# マスターでアプリを1回だけ読み込み、ワーカーはフォークで起動する
+# (Flask/SQLAlchemy の import とテーブル定義の reflect をワーカーごとに繰り返さない)
+preload_app = True
+
+
+def on_starting(server):
+    """マスター起動時に、ワーカーと共有する状態を準備する"""
+    import app
+    app.init_app_state()
+
+
+def post_fork(server, worker):
+    """フォーク直後のワーカーで、マスターから引き継いだコネクションプールを破棄する"""
+    import app
+    app.reset_after_fork()
+
+
+def child_exit(server, worker):
+    """終了したワーカーの livesum ゲージを集計対象から外す"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
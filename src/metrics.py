@@ -0,0 +1,174 @@
+# metrics.py
+
+import os
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, write_to_textfile, CONTENT_TYPE_LATEST, REGISTRY,
+)
+from prometheus_client import multiprocess
+
+# gunicorn のワーカーごとの値を集約するため、PROMETHEUS_MULTIPROC_DIR が
+# 設定されている場合は multiprocess モードで動作する (gunicorn.conf.py 参照)
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# 秒単位のバケット (トークン検証・最初の1行までの時間など短い処理用)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# ストリーミング全体・ローダーの各工程用 (数秒〜数十分)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+ROW_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 5_000_000, 20_000_000)
+BYTE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000, 1_000_000_000, 4_000_000_000)
+
+
+# ====================================================================
+# 1. Webアプリ (src/app.py) 用メトリクス
+# ====================================================================
+
+TOKEN_VALIDATION_SECONDS = Histogram(
+    "stockdata_token_validation_seconds",
+    "トークン検証 (validate_token) にかかった時間",
+    buckets=LATENCY_BUCKETS,
+)
+QUERY_FIRST_ROW_SECONDS = Histogram(
+    "stockdata_query_first_row_seconds",
+    "/download のクエリ実行から最初の1行を受け取るまでの時間",
+    ["plan_type"],
+    buckets=LATENCY_BUCKETS,
+)
+DOWNLOAD_ROWS = Histogram(
+    "stockdata_download_rows",
+    "/download 1回あたりにストリーミングした行数",
+    ["plan_type"],
+    buckets=ROW_BUCKETS,
+)
+DOWNLOAD_BYTES = Histogram(
+    "stockdata_download_bytes",
+    "/download 1回あたりにストリーミングしたバイト数",
+    ["plan_type"],
+    buckets=BYTE_BUCKETS,
+)
+DOWNLOAD_STREAM_SECONDS = Histogram(
+    "stockdata_download_stream_seconds",
+    "/download のストリーミング開始から終了までの時間",
+    ["plan_type"],
+    buckets=DURATION_BUCKETS,
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "stockdata_db_pool_checked_out",
+    "使用中のDBコネクション数 (全ワーカー合計)",
+    multiprocess_mode="livesum",
+)
+DB_POOL_SIZE = Gauge(
+    "stockdata_db_pool_size",
+    "DBコネクションプールのサイズ (全ワーカー合計)",
+    multiprocess_mode="livesum",
+)
+
+
+def instrument_pool(engine):
+    """エンジンのコネクションプールにチェックアウト/チェックインのフックを登録する。
+
+    プールサイズのゲージ (DB_POOL_SIZE) は、リクエストを処理するプロセスで呼び出し側が設定する。
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.dec()
+
+
+def render_latest():
+    """/metrics 用に (本文, Content-Type) を返す"""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# ====================================================================
+# 2. ローダー (scripts/StockData_loader.py) 用メトリクス
+# ====================================================================
+# ローダーは cron から単発で実行されるため、専用のレジストリに記録し、
+# 終了時に node_exporter の textfile collector 用ファイルへ書き出す。
+
+LOADER_REGISTRY = CollectorRegistry()
+
+LOADER_STAGE_SECONDS = Histogram(
+    "stockdata_loader_stage_seconds",
+    "ローダーのチャンクごとの各工程 (fetch/process/validate/upload/merge/aggregate) の処理時間",
+    ["stage"],
+    buckets=DURATION_BUCKETS,
+    registry=LOADER_REGISTRY,
+)
+LOADER_ROWS_MERGED = Counter(
+    "stockdata_loader_rows_merged",
+    "本テーブルへマージした行数",
+    ["table"],
+    registry=LOADER_REGISTRY,
+)
+LOADER_RATE_LIMIT_WAIT_SECONDS = Counter(
+    "stockdata_loader_rate_limit_wait_seconds",
+    "yfinance のレート制限回避のために待機した合計時間",
+    registry=LOADER_REGISTRY,
+)
+LOADER_ROWS_QUARANTINED = Counter(
+    "stockdata_loader_rows_quarantined",
+    "検証で隔離テーブルへ移した行数 (理由別)",
+    ["reason"],
+    registry=LOADER_REGISTRY,
+)
+LOADER_MISSING_TRADING_DAYS = Counter(
+    "stockdata_loader_missing_trading_days",
+    "推定した取引日カレンダーに対する欠損日数の合計",
+    registry=LOADER_REGISTRY,
+)
+LOADER_CHUNKS = Counter(
+    "stockdata_loader_chunks",
+    "処理したチャンク数 (結果別)",
+    ["result"],
+    registry=LOADER_REGISTRY,
+)
+LOADER_LAST_RUN_SECONDS = Gauge(
+    "stockdata_loader_last_run_seconds",
+    "直近のローダー実行にかかった時間",
+    registry=LOADER_REGISTRY,
+)
+LOADER_LAST_SUCCESS_TIMESTAMP = Gauge(
+    "stockdata_loader_last_success_timestamp_seconds",
+    "直近のローダー実行が完了した時刻 (UNIX時間)",
+    registry=LOADER_REGISTRY,
+)
+
+
+def restore_last_success(path):
+    """前回書き出した textfile から最終成功時刻を読み込み、ゲージに設定する。
+
+    失敗したチャンクがあった実行では最終成功時刻を更新せず、前回の値のまま書き出すために使う。
+    """
+    if not path or not os.path.exists(path):
+        return
+    from prometheus_client.parser import text_string_to_metric_families
+    try:
+        with open(path, encoding="utf-8") as f:
+            for family in text_string_to_metric_families(f.read()):
+                if family.name == "stockdata_loader_last_success_timestamp_seconds":
+                    for sample in family.samples:
+                        LOADER_LAST_SUCCESS_TIMESTAMP.set(sample.value)
+    except Exception as e:
+        print(f"Could not read previous loader metrics from {path}: {e}")
+
+
+def write_loader_textfile(path):
+    """ローダーのメトリクスを textfile collector 用ファイルに書き出す"""
+    if not path:
+        return
+    try:
+        write_to_textfile(path, LOADER_REGISTRY)
+        print(f"Loader metrics written to {path}.")
+    except Exception as e:
+        print(f"Error writing loader metrics to {path}: {e}")
@@ -0,0 +1,102 @@
+# tests/test_data_validation.py
+
+import os
+import sys
+from datetime import date
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from scripts.data_validation import validate_rows, previous_closes, REASON_COLUMN
+
+
+def make_rows(code, closes, start=date(2025, 1, 6)):
+    """1銘柄分の日足 (四本値はすべて終値と同じ) を作る"""
+    dates = pd.bdate_range(start, periods=len(closes)).date
+    return pd.DataFrame({
+        "証券コード": code,
+        "銘柄名": "テスト",
+        "日付": dates,
+        "始値": closes,
+        "高値": closes,
+        "安値": closes,
+        "終値": closes,
+        "始値（調整後）": closes,
+        "高値（調整後）": closes,
+        "安値（調整後）": closes,
+        "終値（調整後）": closes,
+        "出来高": 1000,
+    })
+
+
+def test_limit_down_move_is_not_quarantined():
+    # 低位株のストップ安 (80 → 50, -37.5%) は正常な値動き
+    clean, quarantined, _ = validate_rows(make_rows("1001", [80.0, 50.0]))
+    assert quarantined.empty
+    assert len(clean) == 2
+
+
+def test_limit_up_move_of_low_priced_stock_is_not_quarantined():
+    # 100円未満の制限値幅は30円なので、50 → 80 (+60%) はストップ高の範囲内
+    _, quarantined, _ = validate_rows(make_rows("1001", [50.0, 80.0]))
+    assert quarantined.empty
+
+
+def test_moves_beyond_the_price_limit_are_quarantined_in_both_directions():
+    # 基準値段1000円の制限値幅は300円
+    _, up, _ = validate_rows(make_rows("1001", [1000.0, 1400.0]))
+    _, down, _ = validate_rows(make_rows("1001", [1000.0, 600.0]))
+    # 5000円の制限値幅は1000円 (+26% でも制限値幅を超える)
+    _, mid, _ = validate_rows(make_rows("1001", [5000.0, 6300.0]))
+    assert list(up[REASON_COLUMN]) == ["price_jump"]
+    assert list(down[REASON_COLUMN]) == ["price_jump"]
+    assert list(mid[REASON_COLUMN]) == ["price_jump"]
+
+
+def test_boundary_row_uses_price_limit_of_previous_close():
+    clean, _, _ = validate_rows(make_rows("1001", [80.0]), pd.Series({"1001": 50.0}))
+    _, quarantined, _ = validate_rows(make_rows("1001", [1400.0]), pd.Series({"1001": 1000.0}))
+    assert len(clean) == 1
+    assert list(quarantined[REASON_COLUMN]) == ["price_jump"]
+
+
+def test_split_sized_step_in_adjusted_series_is_split_mismatch():
+    _, quarantined, _ = validate_rows(make_rows("1001", [100.0, 50.0]))
+    assert list(quarantined[REASON_COLUMN]) == ["split_mismatch"]
+
+
+def test_ticker_is_not_quarantined_on_every_run_after_a_jump():
+    # 日次実行を3回繰り返す: DB上の終値 100 → 160, 161, 165
+    stockdata = make_rows("1001", [100.0])
+    quarantine = stockdata.iloc[0:0]
+    results = []
+    for day, close in enumerate([160.0, 161.0, 165.0], start=1):
+        chunk = make_rows("1001", [close], start=date(2025, 1, 6 + day))
+        # 隔離テーブルの行も比較基準の候補にする (同じ日付なら本テーブルを優先)
+        prev_close = previous_closes(pd.concat([quarantine, stockdata], ignore_index=True))
+        clean, quarantined, _ = validate_rows(chunk, prev_close)
+        stockdata = pd.concat([stockdata, clean], ignore_index=True)
+        quarantine = pd.concat([quarantine, quarantined.drop(columns=REASON_COLUMN, errors="ignore")], ignore_index=True)
+        results.append(quarantined.empty)
+
+    assert results == [False, True, True]
+    assert list(stockdata["終値"]) == [100.0, 161.0, 165.0]
+
+
+def test_previous_closes_prefers_main_table_on_same_date():
+    quarantined = make_rows("1001", [500.0])
+    stored = make_rows("1001", [100.0])
+    assert previous_closes(pd.concat([quarantined, stored], ignore_index=True))["1001"] == 100.0
+
+
+def test_duplicate_key_keeps_last_row_and_missing_days_are_counted():
+    rows = [make_rows(f"{1000 + i}", [100.0] * 5) for i in range(10)]
+    # 1銘柄は3日目が欠損、別の1銘柄は同じ日付の行が2つある (後ろの行を残す)
+    rows[0] = rows[0].drop(index=2)
+    rows.append(make_rows("1001", [101.0]))
+    clean, quarantined, report = validate_rows(pd.concat(rows, ignore_index=True))
+    assert list(quarantined[REASON_COLUMN]) == ["duplicate_key"]
+    assert quarantined["終値"].tolist() == [100.0]
+    assert report["missing_trading_days"] == 1
+    assert report["tickers_with_missing_days"] == 1
+    assert len(clean) == 49